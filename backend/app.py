@@ -1,33 +1,305 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
+import json
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag, NavigableString, CData
+from bs4.element import AttributeValueWithCharsetSubstitution, DEFAULT_OUTPUT_ENCODING
 import re
+import fcntl
+import sqlite3
+from functools import lru_cache
 from collections import Counter
 from datetime import datetime, timedelta
 import random
-import joblib
+import multiprocessing
+import subprocess
+import sys
+import threading
+import time
 import numpy as np
-import pandas as pd
 from urllib.parse import urlparse
+from soupsieve import escape as css_escape, compile as css_compile
+import lxml.html
+from lxml import etree
+from rule_cache import RuleCache, rule_cache_key
+from fetcher import PageFetcher
+from jobs import JobQueue, MemoryJobStore, SQLiteJobStore
+from model_store import CompactForest, load_model_artifacts, process_rss_mb
+from corpus import TrainingCorpus
+from price_history import PriceHistoryStore, product_key
+from result_cache import ResultCache
+from fingerprint import PageResultCache, content_digest, skeleton_simhash, hamming_distance
+from metrics import Metrics, SamplingProfiler
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 CORS(app)
 
-# Load ML model and vectorizer (will be created by the ML training notebook)
+# HTML parser used for every page; each page is parsed once and the tree shared by all stages
+SUPPORTED_PARSERS = ['lxml', 'html.parser']
+HTML_PARSER = os.environ.get('WEBMINER_PARSER', 'lxml')
+if HTML_PARSER not in SUPPORTED_PARSERS:
+    raise ValueError(f"Unsupported WEBMINER_PARSER '{HTML_PARSER}', expected one of {SUPPORTED_PARSERS}")
+
+# Container selectors are tried cheapest-first until at least this many containers are found
+MIN_CONTAINER_SET = int(os.environ.get('WEBMINER_MIN_CONTAINERS', 2))
+
+# Extraction rules learned per site are reused until they expire or stop matching
+RULE_CACHE_SCOPE = os.environ.get('WEBMINER_RULE_CACHE_SCOPE', 'domain')  # 'domain' or 'path'
+rule_cache = RuleCache(
+    max_entries=int(os.environ.get('WEBMINER_RULE_CACHE_SIZE', 256)),
+    ttl=int(os.environ.get('WEBMINER_RULE_CACHE_TTL', 3600)),
+    directory=os.environ.get('WEBMINER_RULE_CACHE_DIR') or None
+)
+
+# Pooled page fetcher; responses with validators are revalidated from the on-disk cache. Pages are
+# streamed and cut at WEBMINER_MAX_PAGE_BYTES (0 for no limit), which bounds the memory a parse takes
+fetcher = PageFetcher(
+    cache_dir=os.environ.get('WEBMINER_HTTP_CACHE_DIR', 'http_cache') or None,
+    per_host_limit=int(os.environ.get('WEBMINER_HOST_CONCURRENCY', 4)),
+    pool_size=int(os.environ.get('WEBMINER_POOL_SIZE', 10)),
+    max_page_bytes=int(os.environ.get('WEBMINER_MAX_PAGE_BYTES', 8 * 1024 * 1024))
+)
+
+# Page fingerprints (see fingerprint.py): an unchanged page gets the records of its last scrape, and cached rules
+# are only reused on pages whose DOM skeleton is within this many bits of the page they were learned on (64
+# reuses them on any page of the site)
+SIMHASH_THRESHOLD = int(os.environ.get('WEBMINER_SIMHASH_THRESHOLD', 8))
+page_results = PageResultCache(
+    max_entries=int(os.environ.get('WEBMINER_PAGE_RESULT_CACHE_SIZE', 128)),
+    ttl=int(os.environ.get('WEBMINER_PAGE_RESULT_CACHE_TTL', 600))
+)
+
+# Results of POST / are served again by URL (see result_cache.py): as they are for WEBMINER_RESULT_MAX_AGE
+# seconds, then for WEBMINER_RESULT_STALE seconds while a background scrape refreshes them. Requests can
+# limit the age of results with max_age and max_stale or skip the cache with no_cache. WEBMINER_RESULT_CACHE_DB shares
+# results between workers
+RESULT_MAX_AGE = int(os.environ.get('WEBMINER_RESULT_MAX_AGE', 300))
+RESULT_STALE = int(os.environ.get('WEBMINER_RESULT_STALE', 3600))
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('WEBMINER_RESULT_CACHE_SIZE', 256)),
+    stale_ttl=RESULT_STALE,
+    retention=RESULT_MAX_AGE + RESULT_STALE,
+    db_path=os.environ.get('WEBMINER_RESULT_CACHE_DB') or None,
+    # A page cut at WEBMINER_MAX_PAGE_BYTES is scraped again the next time
+    cacheable=lambda scraped_data: not scraped_data['pageInfo'].get('truncated')
+)
+refresh_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('WEBMINER_RESULT_REFRESH_WORKERS', 2)))
+
+# Batch scraping: downloads on threads, parsing and analysis on a process pool
+BATCH_MAX_URLS = int(os.environ.get('WEBMINER_BATCH_MAX_URLS', 500))
+BATCH_FETCH_WORKERS = int(os.environ.get('WEBMINER_BATCH_FETCH_WORKERS', 16))
+BATCH_PARSE_WORKERS = int(os.environ.get('WEBMINER_BATCH_PARSE_WORKERS', os.cpu_count() or 1))
+scrape_pool = None
+
+# Background jobs: 'sqlite' shares them between gunicorn workers, 'memory' keeps them in this process (single worker only)
+JOB_BACKEND = os.environ.get('WEBMINER_JOB_BACKEND', 'sqlite')
+JOB_DB_PATH = os.environ.get('WEBMINER_JOB_DB', 'jobs.sqlite3')
+
+# Stage timings and counters, served at /metrics. Profiling a request with the X-WebMiner-Profile: 1
+# header is only honoured when WEBMINER_PROFILING=1
+metrics = Metrics()
+metrics.describe('candidates_scanned', 'Candidate containers found on analyzed pages')
+metrics.describe('candidates_classified', 'Candidates given to the model (one per repeated group)')
+metrics.describe('candidates_positive', 'Candidates predicted to be product containers')
+metrics.describe('selectors_tried', 'Container, name and price selectors run against pages')
+metrics.describe('products_extracted', 'Products extracted from scraped pages')
+metrics.describe('fingerprint_exact_hits', 'Unchanged pages answered with the records of their last scrape')
+metrics.describe('fingerprint_near_hits', 'Pages scraped with cached rules learned on a page with the same layout')
+metrics.describe('fingerprint_misses', 'Pages analyzed by the model because no cached rules matched their layout')
+PROFILING_ENABLED = os.environ.get('WEBMINER_PROFILING', '0') == '1'
+PROFILE_INTERVAL = float(os.environ.get('WEBMINER_PROFILE_INTERVAL_MS', 5)) / 1000
+
+# Load ML model and vectorizer (created by the ML training notebook, updated by retrain.py)
 MODEL_PATH = 'Model/product_container_model.pkl'
 VECTORIZER_PATH = 'Model/html_vectorizer.pkl'
+# Compact numpy copy of both (see model_store.py); 'auto' prefers it when it matches the pickles
+COMPACT_MODEL_PATH = 'Model/product_container_model.npz'
+MODEL_FORMAT = os.environ.get('WEBMINER_MODEL_FORMAT', 'auto')  # 'auto', 'compact' or 'pickle'
+# Retrained model files are picked up without a restart; they are checked at most this often (seconds)
+MODEL_RELOAD_INTERVAL = float(os.environ.get('WEBMINER_MODEL_RELOAD_INTERVAL', 30))
+RETRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'retrain.py')
+# Held while retrain.py runs, so only one retraining runs across workers and shells
+RETRAIN_LOCK_PATH = 'Model/retrain.lock'
+
+# Pages saved for training while no model exists (see corpus.py)
+TRAINING_CORPUS_DIR = os.environ.get('WEBMINER_TRAINING_CORPUS', 'training_corpus')
+training_corpus = None
+
+# Prices seen while scraping (see price_history.py); with an empty path nothing is stored and the price
+# history of a product only holds its current price
+PRICE_HISTORY_DB = os.environ.get('WEBMINER_PRICE_HISTORY_DB', 'price_history.sqlite3')
+PRICE_HISTORY_DAYS = int(os.environ.get('WEBMINER_PRICE_HISTORY_DAYS', 30))
+# Products whose histories are read in one query; they are streamed once their histories are in
+PRICE_HISTORY_CHUNK = 20
+price_history_store = None
+
+# Patterns used for the has_price / has_product_term candidate features
+PRICE_PATTERN = re.compile(r'(\$|€|£|\d+\.\d{2})')
+PRODUCT_TERM_PATTERN = re.compile(r'product|item|buy|purchase|cart|shop')
+PRICE_NUMBER_PATTERN = re.compile(r'(\d+\.\d+|\d+)')
+GENERIC_PRICE_PATTERN = re.compile(r'(\$|€|£|USD)\s*(\d+(?:\.\d{2})?)')
+PRODUCT_CATEGORIES = ["Electronics", "Clothing", "Home", "Books", "Beauty"]
+
+# Selectors as generate_selectors writes them ('tag.class1.class2' and '#id' without escapes) are
+# matched directly; any other selector goes through soupsieve
+SIMPLE_CLASS_SELECTOR = re.compile(r'([a-zA-Z][\w-]*)((?:\.[\w-]+)+)')
+SIMPLE_ID_SELECTOR = re.compile(r'#([\w-]+)')
+GENERIC_NAME_TAGS = frozenset({'h1', 'h2', 'h3', 'h4'})
+
+# Field selectors that supplied nothing for this many containers of a page are dropped from the
+# cached rules (0 keeps them)
+RULE_PRUNE_MIN_CONTAINERS = int(os.environ.get('WEBMINER_RULE_PRUNE_MIN_CONTAINERS', 20))
+
+# Longest match either pattern needs to see across a text boundary ('purchase' minus one char)
+TEXT_EDGE_LENGTH = 7
+
+# String types counted by get_text() on container tags (no comments, scripts or styles)
+MAIN_TEXT_TYPES = (NavigableString, CData)
+
+# Page metrics: words are maximal runs of word characters, as matched by \b\w+\b
+WORD_PATTERN = re.compile(r'\w+')
+
+# Words left out of frequentWords by the ML-guided and traditional scrapers
+RULES_COMMON_WORDS = frozenset({'the', 'and', 'a', 'to', 'of', 'in', 'is', 'it', 'that', 'for', 'on', 'with'})
+TRADITIONAL_COMMON_WORDS = frozenset({'the', 'and', 'a', 'to', 'of', 'in', 'is', 'it', 'that', 'for', 'on', 'with',
+                                      'as', 'are', 'at', 'be', 'this', 'by', 'an', 'was', 'not'})
+
+# Traditional scraper: shopping terms marking an e-commerce page, and price formats in page text
+ECOMMERCE_PATTERN = re.compile(r'price|cart|checkout|shop|product|buy|purchase')  # matched against lowercased text
+ECOMMERCE_SCAN_CHUNK = 64 * 1024
+PRICE_TEXT_PATTERN = re.compile(
+    r'\$\s*(?P<dollar>\d+(?:\.\d{2})?)'   # $XX.XX
+    r'|(?P<usd>\d+(?:\.\d{2})?)\s*USD'     # XX.XX USD
+    r'|(?P<euro>\d+(?:\.\d{2})?)\s*€'      # XX.XX €
+    r'|£\s*(?P<pound>\d+(?:\.\d{2})?)'     # £XX.XX
+)
+PRICE_TEXT_GROUPS = ('dollar', 'usd', 'euro', 'pound')  # in order of preference
+
+# Characters of each candidate's HTML given to the vectorizer
+SNIPPET_LENGTH = 1000
+
+# Candidates holding more than this share of the page's text are page-level wrappers, which are
+# pruned before classification (1 keeps them)
+WRAPPER_TEXT_SHARE = float(os.environ.get('WEBMINER_WRAPPER_TEXT_SHARE', 0.5))
+
+# Sibling candidates with the same structural signature are classified through their first member
+# when at least this many repeat (0 classifies every candidate)
+REPEATED_GROUP_MIN = int(os.environ.get('WEBMINER_REPEATED_GROUP_MIN', 4))
+
+# Domain categories produced by classify_domain_type, in one-hot column order
+DOMAIN_TYPES = ['electronics', 'books', 'fashion', 'home', 'general', 'other']
+
+# Numeric columns produced by extract_features_from_tag
+TAG_FEATURE_COLUMNS = [
+    'text_length', 'has_price', 'has_product_term', 'has_img', 'has_link',
+    'depth', 'child_count', 'sibling_count',
+    'tag_div', 'tag_li', 'tag_article', 'tag_section', 'tag_span', 'tag_a'
+]
 
-# Check if model exists, otherwise set to None (will train on first request)
+def build_feature_layout(model, vectorizer):
+    """Precompute where each extracted feature lands in the model's input matrix"""
+    html_width = len(vectorizer.get_feature_names_out())
+    
+    if hasattr(model, 'feature_names_in_'):
+        columns = list(model.feature_names_in_)
+    else:
+        # Assume all feature columns are needed (for older scikit-learn versions)
+        columns = (TAG_FEATURE_COLUMNS +
+                   [f"domain_{dt}" for dt in DOMAIN_TYPES] +
+                   [f"html_feat_{i}" for i in range(html_width)])
+    
+    layout = {
+        'columns': columns,
+        'tag_positions': [],
+        'tag_sources': [],
+        'domain_positions': {},
+        'html_positions': [],
+        'html_sources': []
+    }
+    
+    # Columns the model expects but we don't produce stay zero
+    for position, column in enumerate(columns):
+        if column in TAG_FEATURE_COLUMNS:
+            layout['tag_positions'].append(position)
+            layout['tag_sources'].append(column)
+        elif column.startswith('domain_'):
+            layout['domain_positions'][column[len('domain_'):]] = position
+        elif column.startswith('html_feat_'):
+            source = int(column[len('html_feat_'):])
+            if source < html_width:
+                layout['html_positions'].append(position)
+                layout['html_sources'].append(source)
+    
+    return layout
+
+# The model in use as one (model, vectorizer, feature_layout) tuple, so a reload swaps all three at once
+model_artifacts = None
+model_info = {'format': None, 'loadedAt': None, 'signature': None, 'checkedAt': 0.0}
+model_lock = threading.Lock()
+retrain_lock = threading.Lock()
+retrain_process = None
+
+def model_files_signature():
+    """Modification time and size of the model files, which change when they are rewritten"""
+    signature = []
+    for path in (MODEL_PATH, VECTORIZER_PATH, COMPACT_MODEL_PATH):
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return signature
+
+def load_model():
+    """Load the model files and swap them in, returning False if there is no model yet"""
+    global model_artifacts
+    load_started = time.perf_counter()
+    signature = model_files_signature()
+    try:
+        model, vectorizer, model_format = load_model_artifacts(MODEL_PATH, VECTORIZER_PATH, COMPACT_MODEL_PATH, MODEL_FORMAT)
+    except FileNotFoundError:
+        return False
+    
+    model_artifacts = (model, vectorizer, build_feature_layout(model, vectorizer))
+    model_info.update(format=model_format, loadedAt=time.time(), signature=signature)
+    rss = process_rss_mb()
+    print(f"ML model and vectorizer loaded successfully ({model_format}, "
+          f"{time.perf_counter() - load_started:.2f}s" + (f", RSS {rss:.0f} MB)" if rss is not None else ")"))
+    return True
+
+def current_model():
+    """The (model, vectorizer, feature_layout) in use, or None while there is no trained model
+    
+    Reloads the model when its files have changed on disk, e.g. after
+    retrain.py promoted a new one, so every worker picks it up.
+    """
+    now = time.time()
+    if now - model_info['checkedAt'] >= MODEL_RELOAD_INTERVAL and model_lock.acquire(blocking=False):
+        try:
+            model_info['checkedAt'] = now
+            if model_files_signature() != model_info['signature']:
+                previous = model_artifacts
+                if load_model() and previous is not None:
+                    # Cached rules and results come from the previous model
+                    rule_cache.clear()
+                    page_results.clear()
+        except Exception as e:
+            print(f"Reloading the ML model failed, keeping the current one: {str(e)}")
+        finally:
+            model_lock.release()
+    return model_artifacts
+
+# Under gunicorn --preload (see gunicorn.conf.py) this runs once in the master and workers share the result
+model_info['checkedAt'] = time.time()
 try:
-    model = joblib.load(MODEL_PATH)
-    vectorizer = joblib.load(VECTORIZER_PATH)
-    print("ML model and vectorizer loaded successfully")
-except FileNotFoundError:
-    model = None
-    vectorizer = None
-    print("ML model not found. Will train on first request.")
+    if not load_model():
+        print("ML model not found. Will train on first request.")
+except ValueError as e:
+    # current_model() tries again once the files are consistent
+    print(f"Loading the ML model failed: {str(e)}")
 
 @app.route('/', methods=['POST'])
 def receive_url():
@@ -38,74 +310,529 @@ def receive_url():
     
     url = data['url']
     
+    # Stage times are summed for this request; a streamed response finishes it in stream_scrape_records
+    metrics.start_request()
+    if data.get('stream'):
+        try:
+            html_content, truncated = download_page(url)
+            if not html_content:
+                metrics.finish_request()
+                return jsonify({'status': 'error', 'message': 'Failed to download page'}), 500
+            # Page metadata first, then products as their containers are processed
+            lines = stream_scrape_records(iter_scrape_page(url, html_content, truncated))
+            return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+        except Exception as e:
+            metrics.finish_request()
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+    
+    # max_age is the oldest result the client accepts; max_stale accepts results that much older, served while
+    # they are refreshed. A client that sends neither gets the server's windows.
+    for field in ('max_age', 'max_stale'):
+        value = data.get(field, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            metrics.finish_request()
+            return jsonify({'status': 'error', 'message': f'{field} must be a non-negative number of seconds'}), 400
+    max_age = data.get('max_age', RESULT_MAX_AGE)
+    max_stale = data.get('max_stale', 0 if 'max_age' in data else RESULT_STALE)
+    # Results stay fresh for at most RESULT_MAX_AGE and usable for at most RESULT_MAX_AGE + RESULT_STALE
+    fresh_age = min(max_age, RESULT_MAX_AGE)
+    usable_age = min(max_age + max_stale, RESULT_MAX_AGE + RESULT_STALE)
+    
+    profiler = None
+    if PROFILING_ENABLED and request.headers.get('X-WebMiner-Profile') == '1':
+        profiler = SamplingProfiler(interval=PROFILE_INTERVAL).start()
+    
     try:
-        # Download the page
-        html_content = download_page(url)
-        if not html_content:
-            return jsonify({'status': 'error', 'message': 'Failed to download page'}), 500
-            
-        # Check if we have a trained model
-        global model, vectorizer
-        if model is None or vectorizer is None:
-            # We don't have a model yet, use traditional scraping approach
-            scraped_data = scrape_website_traditional(url, html_content)
-            
-            # Save this page for future training
-            domain = extract_domain(url)
-            save_training_example(url, html_content, domain)
-            
-            # Add a note that ML model is being trained
-            scraped_data['notes'] = "ML model is being trained with this page. Future requests will use adaptive scraping."
-        else:
-            # Use ML model to analyze the page and extract data
-            extraction_rules = analyze_website_structure(url, html_content)
-            scraped_data = scrape_with_rules(url, html_content, extraction_rules)
-        
-        return jsonify(scraped_data)
+        # A profiled request always scrapes, there is nothing to see in a cache hit
+        scraped_data, cache_status = None, 'miss'
+        if profiler is None and not data.get('no_cache'):
+            scraped_data, cache_status = result_cache.lookup(url, fresh_age, usable_age - fresh_age)
+            # One refresh per URL, however many requests see the stale result meanwhile
+            if cache_status == 'stale' and result_cache.start_refresh(url):
+                refresh_pool.submit(refresh_cached_result, url, fresh_age)
+        if scraped_data is None:
+            cache_status = 'miss'
+            scraped_data = result_cache.load(url, lambda: download_and_scrape(url))
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
+    finally:
+        timing = metrics.finish_request()
+        profile = profiler.stop() if profiler is not None else None
+    
+    # Cached results are shared, so the extra fields go on a copy
+    scraped_data = dict(scraped_data)
+    if data.get('timing'):
+        scraped_data['timing'] = timing
+    if profile is not None:
+        scraped_data['profile'] = profile
+    response = jsonify(scraped_data)
+    response.headers['X-WebMiner-Cache'] = cache_status
+    return response
 
-def download_page(url, timeout=10):
-    """Download HTML content from URL with proper headers"""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+def download_and_scrape(url):
+    """Download a page and scrape it"""
+    html_content, truncated = download_page(url)
+    if not html_content:
+        raise Exception('Failed to download page')
+    return scrape_page(url, html_content, truncated)
+
+def refresh_cached_result(url, max_age):
+    """Scrape url again to replace its stale cached result; run on refresh_pool
+
+    max_age is the freshness the request that found it stale asked for.
+    Nothing is scraped if the result has been refreshed to that freshness
+    meanwhile, e.g. by another worker.
+    """
+    metrics.start_request()
+    try:
+        result_cache.load(url, lambda: download_and_scrape(url), max_age=max_age)
+    except Exception as e:
+        print(f"Refreshing the cached result for {url} failed: {str(e)}")
+    finally:
+        result_cache.finish_refresh(url)
+        metrics.finish_request()
+
+def stream_scrape_records(records):
+    """Serialize scrape records as NDJSON lines tagged with their type"""
+    try:
+        for kind, payload in records:
+            yield json.dumps({'type': kind, **payload}) + '\n'
+    except Exception as e:
+        # Headers are already sent, so report the failure in-band
+        yield json.dumps({'type': 'error', 'status': 'error', 'message': str(e)}) + '\n'
+    finally:
+        metrics.finish_request()
+
+@app.route('/batch', methods=['POST'])
+def batch_scrape():
+    data = request.get_json()
+    
+    if not data or not isinstance(data.get('urls'), list) or not data['urls']:
+        return jsonify({'status': 'error', 'message': 'No URLs provided'}), 400
+    
+    urls = data['urls']
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({'status': 'error', 'message': f'At most {BATCH_MAX_URLS} URLs per batch'}), 400
+    if not all(isinstance(url, str) and url for url in urls):
+        return jsonify({'status': 'error', 'message': 'URLs must be non-empty strings'}), 400
+    
+    concurrency = data.get('concurrency', BATCH_FETCH_WORKERS)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        return jsonify({'status': 'error', 'message': 'concurrency must be a positive integer'}), 400
+    
+    results = run_batch(urls, min(concurrency, BATCH_FETCH_WORKERS))
+    
+    if data.get('stream'):
+        # One JSON object per line, in completion order
+        lines = (json.dumps(result) + '\n' for result in results)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+    
+    return jsonify({'results': sorted(results, key=lambda result: result['index'])})
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    data = request.get_json()
+    
+    if not data or 'url' not in data:
+        return jsonify({'status': 'error', 'message': 'No URL provided'}), 400
+    
+    job = job_queue.submit(data['url'])
+    if job is None:
+        response = jsonify({'status': 'error', 'message': 'Job queue is full, retry later'})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    
+    return jsonify({'jobId': job['id'], 'status': job['status'], 'statusUrl': f"/jobs/{job['id']}"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+    
+    body = {
+        'jobId': job['id'],
+        'url': job['url'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'createdAt': datetime.fromtimestamp(job['created_at']).isoformat(),
+        'updatedAt': datetime.fromtimestamp(job['updated_at']).isoformat()
     }
+    if job['status'] == 'done':
+        body['result'] = job['result']
+    elif job['status'] == 'failed':
+        body['message'] = job['error']
+    return jsonify(body)
+
+@app.route('/model', methods=['GET'])
+def model_status():
+    artifacts = current_model()
+    return jsonify({
+        'loaded': artifacts is not None,
+        'format': model_info['format'],
+        'loadedAt': datetime.fromtimestamp(model_info['loadedAt']).isoformat() if model_info['loadedAt'] else None,
+        'features': len(artifacts[2]['columns']) if artifacts is not None else 0,
+        'retraining': retrain_status()
+    })
+
+@app.route('/model/retrain', methods=['POST'])
+def start_retraining():
+    global retrain_process
+    data = request.get_json(silent=True) or {}
+    
+    with retrain_lock:
+        # The lock also covers retrainings started by other workers or from a shell
+        lock_fd = acquire_retrain_lock()
+        if lock_fd is None:
+            return jsonify({'status': 'error', 'message': 'Retraining is already running'}), 409
+        
+        # Training runs in its own process, which inherits the lock and holds it until it exits;
+        # every worker picks the new files up in current_model()
+        try:
+            command = [sys.executable, RETRAIN_SCRIPT, '--corpus', TRAINING_CORPUS_DIR, '--lock-fd', str(lock_fd)]
+            if data.get('force'):
+                command.append('--force')
+            retrain_process = subprocess.Popen(command, pass_fds=(lock_fd,))
+        finally:
+            os.close(lock_fd)
+    
+    return jsonify({'status': 'started', 'statusUrl': '/model'}), 202
+
+def acquire_retrain_lock(fd=None):
+    """Lock RETRAIN_LOCK_PATH (or the already open fd) without waiting; returns the fd, or None if it is held"""
+    if fd is None:
+        fd = os.open(RETRAIN_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        response = requests.get(url, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        return response.text
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def retrain_status():
+    """Outcome of the last retraining started by this worker (see the exit codes in retrain.py)"""
+    if retrain_process is None:
+        return None
+    code = retrain_process.poll()
+    if code is None:
+        return 'running'
+    return {0: 'promoted', 2: 'rejected'}.get(code, 'failed')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'extractionRules': rule_cache.stats(), 'pageResults': page_results.stats(),
+                    'results': result_cache.stats(), 'http': fetcher.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    rules = rule_cache.stats()
+    results = result_cache.stats()
+    http = fetcher.stats()
+    jobs = job_queue.stats()
+    extra = [
+        ('rule_cache_hits_total', 'counter', 'Extraction rule cache hits', rules['hits']),
+        ('rule_cache_misses_total', 'counter', 'Extraction rule cache misses', rules['misses']),
+        ('rule_cache_invalidations_total', 'counter', 'Cached rules dropped because they stopped matching',
+         rules['invalidations']),
+        ('rule_cache_entries', 'gauge', 'Extraction rules currently cached', rules['entries']),
+        ('page_result_cache_entries', 'gauge', 'Page results currently cached by content',
+         page_results.stats()['entries']),
+        ('result_cache_hits_total', 'counter', 'Scrape requests answered with a fresh cached result', results['hits']),
+        ('result_cache_stale_hits_total', 'counter', 'Scrape requests answered with a stale result while it is refreshed',
+         results['staleHits']),
+        ('result_cache_misses_total', 'counter', 'Scrape requests without a usable cached result', results['misses']),
+        ('result_cache_coalesced_total', 'counter', 'Scrapes that waited for a scrape of the same URL already running',
+         results['coalesced']),
+        ('http_requests_total', 'counter', 'Pages requested from remote sites', http['requests']),
+        ('http_not_modified_total', 'counter', 'Page requests answered from the HTTP cache with a 304',
+         http['notModified']),
+        ('http_downloaded_bytes_total', 'counter', 'Bytes of page content downloaded', http['bytesDownloaded']),
+        ('http_truncated_pages_total', 'counter', 'Pages cut at WEBMINER_MAX_PAGE_BYTES', http['truncated']),
+        # Finished jobs are counted until their results expire (WEBMINER_JOB_RESULT_TTL)
+        *[(f'jobs_{status}', 'gauge', f'Scrape jobs in the {status} state', jobs['jobs'].get(status, 0))
+          for status in ('queued', 'running', 'done', 'failed')],
+        ('job_queue_limit', 'gauge', 'Queued jobs at which POST /jobs answers 429', jobs['maxQueued']),
+        ('job_workers', 'gauge', 'Threads running jobs in this worker process', jobs['workers']),
+        ('model_loaded', 'gauge', '1 while a product container model is loaded', int(model_artifacts is not None))
+    ]
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+@app.route('/price-history', methods=['GET'])
+def query_price_history():
+    domain = request.args.get('domain')
+    name = request.args.get('product')
+    if not domain or not name:
+        return jsonify({'status': 'error', 'message': 'domain and product are required'}), 400
+    store = get_price_history_store()
+    if store is None:
+        return jsonify({'status': 'error', 'message': 'Price history is disabled'}), 404
+    
+    # since and until are unix times; points or bucket (seconds) downsample the range
+    return jsonify({
+        'domain': domain,
+        'product': name,
+        'points': store.history(domain, name, request.args.get('since', type=float),
+                                request.args.get('until', type=float), request.args.get('points', type=int),
+                                request.args.get('bucket', type=int))
+    })
+
+def scrape_page(url, html_content, truncated=False):
+    """Parse a downloaded page and extract its data with the ML model or the traditional scraper"""
+    return collect_scrape_records(iter_scrape_page(url, html_content, truncated))
+
+def iter_scrape_page(url, html_content, truncated=False):
+    """Yield the scrape_page result as records, so it can be streamed as it is produced
+    
+    pageInfo.truncated tells whether the page was cut at the download size
+    limit; the records of a truncated page are not cached.
+    """
+    for kind, payload in iter_scrape_page_records(url, html_content, truncated):
+        if kind == 'page':
+            payload = {**payload, 'pageInfo': {**payload['pageInfo'], 'truncated': truncated}}
+        yield kind, payload
+
+def iter_scrape_page_records(url, html_content, truncated):
+    """The records of iter_scrape_page, before pageInfo.truncated is set"""
+    # Check if we have a trained model
+    if current_model() is None:
+        # We don't have a model yet, use traditional scraping approach
+        records = iter_scrape_website_traditional(url, html_content)
+        kind, page = next(records)
+        
+        # Save this page for future training
+        domain = extract_domain(url)
+        save_training_example(url, html_content, domain)
+        
+        # Add a note that ML model is being trained
+        page['notes'] = "ML model is being trained with this page. Future requests will use adaptive scraping."
+        yield kind, page
+        yield from records
+        return
+    
+    if truncated:
+        # Part of the page is missing, it must not answer for the whole page later
+        yield from iter_scrape_with_model(url, html_content)
+        return
+    
+    # A page seen unchanged on this site is answered without parsing it
+    domain = extract_domain(url)
+    with metrics.stage('fingerprint'):
+        result_key = f"{domain}:{content_digest(html_content)}"
+    cached_records = page_results.get(result_key)
+    if cached_records is not None:
+        metrics.inc('fingerprint_exact_hits')
+        yield from replay_scrape_records(url, domain, cached_records)
+        return
+    
+    yield from remember_scrape_records(iter_scrape_with_model(url, html_content), result_key)
+
+def iter_scrape_with_model(url, html_content):
+    """Scrape with the cached rules of the site if they fit the page's layout, otherwise learn new ones"""
+    # Parse once and share the tree between analysis and extraction
+    soup = parse_html(html_content)
+    with metrics.stage('fingerprint'):
+        skeleton = skeleton_simhash(soup)
+    
+    # Reuse the rules learned for this site if we have them and the page looks like the one they came from
+    cache_key = rule_cache_key(url, RULE_CACHE_SCOPE)
+    extraction_rules = rule_cache.get(cache_key)
+    if extraction_rules is not None and not same_layout(extraction_rules, skeleton):
+        extraction_rules = None
+    
+    if extraction_rules is not None:
+        records = iter_scrape_with_rules(url, html_content, extraction_rules, soup)
+        kind, page = next(records)
+        if page['extractionMethod'] == 'ML-guided':
+            metrics.inc('fingerprint_near_hits')
+            yield kind, page
+            yield from prune_cached_rules(records, cache_key, extraction_rules)
+            return
+        # Cached rules no longer find product containers, learn them again
+        records.close()
+        rule_cache.invalidate(cache_key)
+    
+    # Use ML model to analyze the page and extract data
+    metrics.inc('fingerprint_misses')
+    extraction_rules = analyze_website_structure(url, html_content, soup)
+    extraction_rules['fingerprint'] = skeleton
+    records = iter_scrape_with_rules(url, html_content, extraction_rules, soup)
+    kind, page = next(records)
+    if page['extractionMethod'] == 'ML-guided':
+        rule_cache.put(cache_key, extraction_rules)
+        yield kind, page
+        yield from prune_cached_rules(records, cache_key, extraction_rules)
+        return
+    yield kind, page
+    yield from records
+
+def same_layout(extraction_rules, skeleton):
+    """True if the rules were learned on a page whose skeleton is within SIMHASH_THRESHOLD bits of this one"""
+    learned_on = extraction_rules.get('fingerprint')
+    # Rules cached before fingerprints were recorded are reused as before
+    return learned_on is None or hamming_distance(learned_on, skeleton) <= SIMHASH_THRESHOLD
+
+def remember_scrape_records(records, key):
+    """Pass scrape records through and cache them once the page has been scraped completely"""
+    kept = []
+    for record in records:
+        kept.append(record)
+        yield record
+    page_results.put(key, kept)
+
+def replay_scrape_records(url, domain, records):
+    """Yield the cached records of an unchanged page as a scrape of it made now
+    
+    The prices are recorded again as a new observation, unless the page fell
+    back to the traditional scraper, whose products are not all read from
+    the page.
+    """
+    products = []
+    for kind, payload in records:
+        if kind == 'page':
+            page_info = {**payload['pageInfo'], 'url': url, 'lastScraped': datetime.now().isoformat()}
+            payload = {**payload, 'pageInfo': page_info}
+            ml_guided = payload['extractionMethod'] == 'ML-guided'
+        elif kind == 'product':
+            products.append(payload['product'])
+        yield kind, payload
+    if ml_guided:
+        record_prices(domain, products)
+
+def prune_cached_rules(records, cache_key, extraction_rules):
+    """Pass scrape records through, then cache the rules without the selectors that supplied nothing"""
+    for kind, payload in records:
+        if kind == 'summary':
+            pruned = prune_dead_selectors(extraction_rules, payload.get('ruleStats'))
+            if pruned is not None:
+                rule_cache.put(cache_key, pruned)
+        yield kind, payload
+
+def run_scrape_job(url, report_stage):
+    """Job handler: download and scrape one URL, reporting each stage"""
+    metrics.start_request()
+    try:
+        report_stage('downloading')
+        html_content, truncated = download_page(url)
+        if not html_content:
+            raise Exception('Failed to download page')
+        
+        report_stage('analyzing')
+        return scrape_page(url, html_content, truncated)
+    finally:
+        metrics.finish_request()
+
+def get_scrape_pool():
+    """Process pool running scrape_page for batches, created on first use
+    
+    By then this process runs refresh, job and download threads, and a
+    child forked from it could inherit a lock one of them held, so the
+    children are started by a forkserver instead (they import the app and
+    load the model themselves).
+    """
+    global scrape_pool
+    if scrape_pool is None:
+        scrape_pool = ProcessPoolExecutor(max_workers=BATCH_PARSE_WORKERS,
+                                          mp_context=multiprocessing.get_context('forkserver'))
+    return scrape_pool
+
+def run_batch(urls, fetch_workers):
+    """Scrape many URLs, yielding one result per URL as soon as it is ready
+    
+    Downloads run on a thread pool and each finished page is handed to the
+    process pool for parsing and analysis, so network I/O overlaps with CPU
+    work. A failure only affects the result of its own URL.
+    """
+    global scrape_pool
+    pool = get_scrape_pool()
+    
+    with ThreadPoolExecutor(max_workers=fetch_workers) as downloads:
+        stage_of = {}
+        for index, url in enumerate(urls):
+            stage_of[downloads.submit(download_page, url)] = ('download', index)
+        pending = set(stage_of)
+        
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, index = stage_of.pop(future)
+                url = urls[index]
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        # A worker died; start a fresh pool for the next batch
+                        scrape_pool = None
+                    yield {'index': index, 'url': url, 'status': 'error', 'message': str(e)}
+                    continue
+                
+                if stage == 'download':
+                    html_content, truncated = outcome
+                    if not html_content:
+                        yield {'index': index, 'url': url, 'status': 'error', 'message': 'Failed to download page'}
+                        continue
+                    try:
+                        scrape_future = pool.submit(scrape_page, url, html_content, truncated)
+                    except BrokenProcessPool as e:
+                        scrape_pool = None
+                        yield {'index': index, 'url': url, 'status': 'error', 'message': str(e)}
+                        continue
+                    stage_of[scrape_future] = ('scrape', index)
+                    pending.add(scrape_future)
+                else:
+                    yield {'index': index, 'url': url, 'status': 'success', 'data': outcome}
+
+def download_page(url, timeout=10):
+    """Download HTML content from URL with proper headers, returning (html, truncated)"""
+    try:
+        with metrics.stage('download'):
+            return fetcher.fetch_page(url, timeout=timeout)
     except requests.exceptions.RequestException as e:
         raise Exception(f"Failed to fetch URL: {str(e)}")
 
+def parse_html(html_content, parser=None):
+    """Parse HTML with the configured parser (WEBMINER_PARSER, lxml by default)"""
+    with metrics.stage('parse'):
+        return BeautifulSoup(html_content, parser or HTML_PARSER)
+
+def page_title(soup):
+    """Title of the page as a plain string (NavigableStrings drag the whole tree along when pickled)"""
+    if not soup.title:
+        return "No title found"
+    title = soup.title.string
+    return str(title) if title is not None else None
+
 def extract_domain(url):
     """Extract the domain from a URL"""
     parsed_uri = urlparse(url)
     return parsed_uri.netloc
 
+def get_training_corpus():
+    """Training corpus, opened on first use so its directory only appears once a page is saved"""
+    global training_corpus
+    if training_corpus is None:
+        training_corpus = TrainingCorpus(TRAINING_CORPUS_DIR)
+    return training_corpus
+
+def get_price_history_store():
+    """Price history store, opened on first use; None when WEBMINER_PRICE_HISTORY_DB is empty"""
+    global price_history_store
+    if price_history_store is None and PRICE_HISTORY_DB:
+        price_history_store = PriceHistoryStore(PRICE_HISTORY_DB)
+    return price_history_store
+
 def save_training_example(url, html, domain):
     """Save a training example for future model training"""
-    training_dir = "training_data"
-    if not os.path.exists(training_dir):
-        os.makedirs(training_dir)
-    
-    # Save HTML file
-    filename = f"{training_dir}/{domain.replace('.', '_')}_{datetime.now().strftime('%Y%m%d%H%M%S')}.html"
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(html)
-    
-    # Save URL mapping
-    with open(f"{training_dir}/url_mapping.txt", 'a') as f:
-        f.write(f"{filename}|{url}|{domain}\n")
-    
-    print(f"Saved training example: {filename}")
+    # Pages are stored once per content hash, repeated captures only add an index row
+    with metrics.stage('save_training'):
+        digest, is_new = get_training_corpus().add(url, html, domain)
+    print(f"Saved training example: {digest}" + ("" if is_new else " (page already stored)"))
 
-def analyze_website_structure(url, html_content):
+def analyze_website_structure(url, html_content, soup=None):
     """Analyze website structure using the ML model and extract patterns"""
-    soup = BeautifulSoup(html_content, 'html.parser')
+    if soup is None:
+        soup = parse_html(html_content)
     domain = extract_domain(url)
     
-    # Extract features from potential product containers
-    candidates = soup.select('div, li, article, section')
     results = {
         'product_containers': [],
         'price_tags': [],
@@ -114,53 +841,58 @@ def analyze_website_structure(url, html_content):
         'button_tags': []
     }
     
-    for tag in candidates:
-        # Skip very small tags
-        if len(tag.get_text(strip=True)) < 10:
-            continue
-            
-        features = extract_features_from_tag(tag)
-        features['domain_type'] = classify_domain_type(domain)
-        features['html_structure'] = str(tag)[:1000]
-        
-        # Convert to DataFrame for prediction
-        tag_df = pd.DataFrame([features])
-        
-        # Process HTML with vectorizer
-        html_features = vectorizer.transform([features['html_structure']])
-        
-        # Prepare domain features
-        domain_types = ['electronics', 'books', 'fashion', 'home', 'general', 'other']
-        domain_cols = [f"domain_{dt}" for dt in domain_types]
-        domain_vals = {col: 1 if col == f"domain_{features['domain_type']}" else 0 for col in domain_cols}
-        domain_df = pd.DataFrame([domain_vals])
-        
-        # Get expected feature columns from model
-        if hasattr(model, 'feature_names_in_'):
-            expected_columns = model.feature_names_in_
-        else:
-            # Assume all feature columns are needed (for older scikit-learn versions)
-            html_cols = [f"html_feat_{i}" for i in range(html_features.shape[1])]
-            expected_columns = list(tag_df.columns) + domain_cols + html_cols
-        
-        # Combine features
-        combined_features = pd.concat([
-            tag_df.drop(['html_structure', 'domain_type'], axis=1, errors='ignore'),
-            domain_df,
-            pd.DataFrame(html_features.toarray(), columns=[f"html_feat_{i}" for i in range(html_features.shape[1])])
-        ], axis=1)
-        
-        # Ensure columns match training data
-        for col in expected_columns:
-            if col not in combined_features.columns:
-                combined_features[col] = 0
-        
-        # Reorder columns to match training data
-        combined_features = combined_features[expected_columns]
-        
-        # Predict if this tag is a product container
-        prediction = model.predict(combined_features)[0]
+    # Repeated siblings (the items of a listing) are classified through one representative each,
+    # and the model runs once per page on all representatives
+    with metrics.stage('featurize'):
+        tag_statistics = compute_tag_statistics(soup)
+        candidate_tags = select_candidates(soup, tag_statistics)
+        groups = group_repeated_candidates(candidate_tags)
+        representatives = [candidate_tags[group[0]] for group in groups]
+        feature_rows, html_snippets = candidate_inputs(representatives, tag_statistics)
+    domain_type = classify_domain_type(domain)
+    
+    with metrics.stage('predict'):
+        group_predictions = predict_product_containers(feature_rows, html_snippets, domain_type)
+    predictions = [0] * len(candidate_tags)
+    for group, prediction in zip(groups, group_predictions):
+        for index in group:
+            predictions[index] = prediction
+    metrics.inc('candidates_scanned', len(candidate_tags))
+    metrics.inc('candidates_classified', len(representatives))
+    metrics.inc('candidates_positive', sum(predictions))
+    
+    with metrics.stage('element_signatures'):
+        collect_element_signatures(candidate_tags, predictions, results)
+    
+    with metrics.stage('selectors'):
+        # Generate selectors for each element type
+        selectors = {
+            'product_containers': generate_selectors(results['product_containers']),
+            'price_elements': generate_selectors(results['price_tags']),
+            'name_elements': generate_selectors(results['name_tags']),
+            'image_elements': generate_selectors(results['image_tags']),
+            'button_elements': generate_selectors(results['button_tags'])
+        }
         
+        # Analyze and find patterns in collected data
+        patterns = analyze_patterns(results)
+    
+    # Create extraction rules
+    extraction_rules = {
+        'url': url,
+        'domain': domain,
+        'selectors': selectors,
+        'patterns': patterns
+    }
+    
+    return extraction_rules
+
+def collect_element_signatures(candidate_tags, predictions, results):
+    """Add the signatures of predicted containers and of the price, name, image and button elements in them to results"""
+    # Share sibling positions and ancestor paths between all XPaths on this page
+    xpath_for = xpath_generator()
+    
+    for tag, prediction in zip(candidate_tags, predictions):
         if prediction == 1:
             # Add this tag to product containers
             tag_signature = {
@@ -168,7 +900,7 @@ def analyze_website_structure(url, html_content):
                 'classes': tag.get('class', []),
                 'id': tag.get('id', ''),
                 'attributes': {k: v for k, v in tag.attrs.items() if k not in ['class', 'id']},
-                'xpath': generate_xpath(tag)
+                'xpath': xpath_for(tag)
             }
             results['product_containers'].append(tag_signature)
             
@@ -180,7 +912,7 @@ def analyze_website_structure(url, html_content):
                         'tag': price_el.name,
                         'classes': price_el.get('class', []),
                         'id': price_el.get('id', ''),
-                        'xpath': generate_xpath(price_el)
+                        'xpath': xpath_for(price_el)
                     }
                     results['price_tags'].append(price_sig)
             
@@ -192,7 +924,7 @@ def analyze_website_structure(url, html_content):
                         'tag': name_el.name,
                         'classes': name_el.get('class', []),
                         'id': name_el.get('id', ''),
-                        'xpath': generate_xpath(name_el)
+                        'xpath': xpath_for(name_el)
                     }
                     results['name_tags'].append(name_sig)
                     
@@ -205,7 +937,7 @@ def analyze_website_structure(url, html_content):
                     'id': img_el.get('id', ''),
                     'src': img_el.get('src', ''),
                     'alt': img_el.get('alt', ''),
-                    'xpath': generate_xpath(img_el)
+                    'xpath': xpath_for(img_el)
                 }
                 results['image_tags'].append(img_sig)
                 
@@ -219,47 +951,182 @@ def analyze_website_structure(url, html_content):
                         'classes': btn_el.get('class', []),
                         'id': btn_el.get('id', ''),
                         'text': btn_el.get_text(strip=True),
-                        'xpath': generate_xpath(btn_el)
+                        'xpath': xpath_for(btn_el)
                     }
                     results['button_tags'].append(btn_sig)
+
+def extract_candidates(soup):
+    """Potential product containers of a page with their features and HTML snippets
     
-    # Generate selectors for each element type
-    selectors = {
-        'product_containers': generate_selectors(results['product_containers']),
-        'price_elements': generate_selectors(results['price_tags']),
-        'name_elements': generate_selectors(results['name_tags']),
-        'image_elements': generate_selectors(results['image_tags']),
-        'button_elements': generate_selectors(results['button_tags'])
-    }
+    Returns (tags, feature_rows, html_snippets); retrain.py builds its
+    training rows with this as well.
+    """
+    tag_statistics = compute_tag_statistics(soup)
+    candidate_tags = select_candidates(soup, tag_statistics)
+    feature_rows, html_snippets = candidate_inputs(candidate_tags, tag_statistics)
+    return candidate_tags, feature_rows, html_snippets
+
+def select_candidates(soup, tag_statistics):
+    """Tags that could be product containers, in document order"""
+    max_text_length = WRAPPER_TEXT_SHARE * tag_statistics[id(soup)]['text_length']
+    candidate_tags = []
     
-    # Analyze and find patterns in collected data
-    patterns = analyze_patterns(results)
+    for tag in soup.select('div, li, article, section'):
+        # Skip very small tags and wrappers around most of the page
+        text_length = tag_statistics[id(tag)]['text_length']
+        if 10 <= text_length <= max_text_length:
+            candidate_tags.append(tag)
     
-    # Create extraction rules
-    extraction_rules = {
-        'url': url,
-        'domain': domain,
-        'selectors': selectors,
-        'patterns': patterns
-    }
+    return candidate_tags
+
+def candidate_inputs(candidate_tags, tag_statistics):
+    """Feature rows and HTML snippets of candidate tags, as the model takes them"""
+    feature_rows = [extract_features_from_tag(tag, tag_statistics) for tag in candidate_tags]
+    html_snippets = [html_snippet(tag) for tag in candidate_tags]
+    return feature_rows, html_snippets
+
+def structural_signature(tag):
+    """Shape of a tag: its name, classes and the names of its child tags"""
+    return (tag.name, tuple(tag.get('class', ())),
+            tuple(child.name for child in tag.children if isinstance(child, Tag)))
+
+def group_repeated_candidates(candidate_tags, min_size=None):
+    """Group candidates that are siblings with the same structural signature
     
-    return extraction_rules
+    Returns lists of indexes into candidate_tags ordered by their first
+    member. Groups smaller than min_size (REPEATED_GROUP_MIN by default)
+    are split into one group per candidate.
+    """
+    min_size = REPEATED_GROUP_MIN if min_size is None else min_size
+    if min_size <= 0:
+        return [[index] for index in range(len(candidate_tags))]
+    
+    groups = {}
+    for index, tag in enumerate(candidate_tags):
+        groups.setdefault((id(tag.parent), structural_signature(tag)), []).append(index)
+    
+    result = []
+    for group in groups.values():
+        if len(group) >= min_size:
+            result.append(group)
+        else:
+            result.extend([index] for index in group)
+    result.sort(key=lambda group: group[0])
+    return result
 
-def extract_features_from_tag(tag):
-    """Extract features from a BeautifulSoup tag"""
-    features = {
-        'tag_name': tag.name,
-        'class': ' '.join(tag.get('class', [])),
-        'id': tag.get('id', ''),
-        'text_length': len(tag.get_text(strip=True)),
-        'has_price': 1 if re.search(r'(\$|€|£|\d+\.\d{2})', tag.get_text()) else 0,
-        'has_product_term': 1 if re.search(r'product|item|buy|purchase|cart|shop', tag.get_text().lower()) else 0,
-        'has_img': 1 if tag.find('img') else 0,
-        'has_link': 1 if tag.find('a') else 0,
-        'depth': len(list(tag.parents)),
-        'child_count': len(tag.contents),
-        'sibling_count': len(list(tag.next_siblings)) + len(list(tag.previous_siblings))
-    }
+def html_snippet(tag, limit=SNIPPET_LENGTH):
+    """str(tag)[:limit], serializing only as much of the subtree as needed
+    
+    Output matches Tag.decode() with the default 'minimal' formatter:
+    attributes in formatter order, void elements as <br/>, and strings
+    rendered by their own output_ready().
+    """
+    formatter = tag.formatter_for_name('minimal')
+    pieces = []
+    length = 0
+    # Nodes still to render, last first; plain str items are closing tags
+    pending = [tag]
+    while pending and length < limit:
+        node = pending.pop()
+        if type(node) is str:
+            piece = node
+        elif isinstance(node, Tag):
+            piece = opening_tag(node, formatter)
+            if not node.is_empty_element:
+                prefix = node.prefix + ':' if node.prefix else ''
+                pending.append(f"</{prefix}{node.name}>")
+                pending.extend(reversed(node.contents))
+        else:
+            piece = node.output_ready(formatter)
+        pieces.append(piece)
+        length += len(piece)
+    return ''.join(pieces)[:limit]
+
+def opening_tag(tag, formatter):
+    """The start tag of tag as Tag.decode() renders it"""
+    attributes = []
+    for key, value in formatter.attributes(tag):
+        if value is None:
+            attributes.append(key)
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(value)
+        elif not isinstance(value, str):
+            value = str(value)
+        elif isinstance(value, AttributeValueWithCharsetSubstitution):
+            # <meta> charsets are rewritten to the output encoding (encode() before bs4 4.13)
+            substitute = getattr(value, 'substitute_encoding', None) or value.encode
+            value = substitute(DEFAULT_OUTPUT_ENCODING)
+        attributes.append(f"{key}={formatter.quoted_attribute_value(formatter.attribute_value(value))}")
+    
+    prefix = tag.prefix + ':' if tag.prefix else ''
+    attribute_string = ' ' + ' '.join(attributes) if attributes else ''
+    closing_slash = (formatter.void_element_close_prefix or '') if tag.is_empty_element else ''
+    return f"<{prefix}{tag.name}{attribute_string}{closing_slash}>"
+
+def predict_product_containers(feature_rows, html_snippets, domain_type, artifacts=None):
+    """Classify all candidate tags of a page with a single model call
+    
+    artifacts is a (model, vectorizer, feature_layout) tuple, by default
+    the model currently in use.
+    """
+    if not feature_rows:
+        return []
+    
+    model, vectorizer, layout = artifacts or current_model()
+    matrix = np.zeros((len(feature_rows), len(layout['columns'])))
+    
+    # Structural features
+    if layout['tag_positions']:
+        matrix[:, layout['tag_positions']] = [
+            [row[column] for column in layout['tag_sources']] for row in feature_rows
+        ]
+    
+    # Domain one-hot encoding is the same for every candidate on the page
+    if domain_type in layout['domain_positions']:
+        matrix[:, layout['domain_positions'][domain_type]] = 1
+    
+    # Process HTML with vectorizer, keeping it sparse until the needed columns are picked
+    if layout['html_positions']:
+        html_features = vectorizer.transform(html_snippets)[:, layout['html_sources']]
+        # The compact vectorizer returns a dense array already
+        matrix[:, layout['html_positions']] = html_features.toarray() if hasattr(html_features, 'toarray') else html_features
+    
+    if isinstance(model, CompactForest):
+        return model.predict(matrix)
+    
+    # Pickled models were fitted on a DataFrame and warn without column names. scikit-learn has
+    # imported pandas already, so this adds nothing to startup when the compact model is used
+    import pandas as pd
+    return model.predict(pd.DataFrame(matrix, columns=layout['columns'], copy=False))
+
+def extract_features_from_tag(tag, tag_statistics=None):
+    """Extract features from a BeautifulSoup tag
+    
+    When a table from compute_tag_statistics is given the subtree statistics
+    are read from it instead of being recomputed for this tag.
+    """
+    if tag_statistics is not None:
+        features = {
+            'tag_name': tag.name,
+            'class': ' '.join(tag.get('class', [])),
+            'id': tag.get('id', '')
+        }
+        features.update(tag_statistics[id(tag)])
+    else:
+        features = {
+            'tag_name': tag.name,
+            'class': ' '.join(tag.get('class', [])),
+            'id': tag.get('id', ''),
+            'text_length': len(tag.get_text(strip=True)),
+            'has_price': 1 if re.search(r'(\$|€|£|\d+\.\d{2})', tag.get_text()) else 0,
+            'has_product_term': 1 if re.search(r'product|item|buy|purchase|cart|shop', tag.get_text().lower()) else 0,
+            'has_img': 1 if tag.find('img') else 0,
+            'has_link': 1 if tag.find('a') else 0,
+            'depth': len(list(tag.parents)),
+            'child_count': len(tag.contents),
+            'sibling_count': len(list(tag.next_siblings)) + len(list(tag.previous_siblings))
+        }
     
     # One-hot encode tag_name for common tags
     common_tags = ['div', 'li', 'article', 'section', 'span', 'a']
@@ -268,6 +1135,86 @@ def extract_features_from_tag(tag):
     
     return features
 
+def compute_tag_statistics(soup):
+    """Compute the subtree features of every tag in one post-order walk
+    
+    Returns a dict keyed by id(tag) holding the same text_length, has_price,
+    has_product_term, has_img, has_link, depth, child_count and sibling_count
+    values extract_features_from_tag computes per tag. Text is aggregated
+    bottom-up, keeping only the first and last few characters of each subtree
+    so that pattern matches spanning child boundaries are still found.
+    """
+    # Pre-order pass: document order and depth of every tag
+    order = []
+    depths = {}
+    stack = [(soup, 0)]
+    while stack:
+        node, depth = stack.pop()
+        order.append(node)
+        depths[id(node)] = depth
+        for child in reversed(node.contents):
+            if isinstance(child, Tag):
+                stack.append((child, depth + 1))
+    
+    # Reversed pre-order visits every tag after all of its descendants
+    aggregates = {}
+    statistics = {}
+    for node in reversed(order):
+        text_length = 0
+        has_price = False
+        has_product_term = False
+        has_img = False
+        has_link = False
+        prefix = ''
+        suffix = ''
+        
+        for child in node.contents:
+            if isinstance(child, Tag):
+                (child_length, child_price, child_term, child_img, child_link,
+                 piece_prefix, piece_suffix) = aggregates.pop(id(child))
+                text_length += child_length
+                has_price = has_price or child_price
+                has_product_term = has_product_term or child_term
+                has_img = has_img or child_img or child.name == 'img'
+                has_link = has_link or child_link or child.name == 'a'
+            elif type(child) in MAIN_TEXT_TYPES:
+                text = str(child)
+                text_length += len(text.strip())
+                has_price = has_price or PRICE_PATTERN.search(text) is not None
+                has_product_term = has_product_term or PRODUCT_TERM_PATTERN.search(text.lower()) is not None
+                piece_prefix = text[:TEXT_EDGE_LENGTH]
+                piece_suffix = text[-TEXT_EDGE_LENGTH:]
+            else:
+                continue
+            
+            if not piece_prefix:
+                continue
+            
+            # Check for matches spanning the boundary with the text seen so far
+            if suffix:
+                window = suffix + piece_prefix
+                has_price = has_price or PRICE_PATTERN.search(window) is not None
+                has_product_term = has_product_term or PRODUCT_TERM_PATTERN.search(window.lower()) is not None
+            if len(prefix) < TEXT_EDGE_LENGTH:
+                prefix = (prefix + piece_prefix)[:TEXT_EDGE_LENGTH]
+            suffix = (suffix + piece_suffix)[-TEXT_EDGE_LENGTH:]
+        
+        aggregates[id(node)] = (text_length, has_price, has_product_term, has_img, has_link, prefix, suffix)
+        
+        parent = node.parent
+        statistics[id(node)] = {
+            'text_length': text_length,
+            'has_price': 1 if has_price else 0,
+            'has_product_term': 1 if has_product_term else 0,
+            'has_img': 1 if has_img else 0,
+            'has_link': 1 if has_link else 0,
+            'depth': depths[id(node)],
+            'child_count': len(node.contents),
+            'sibling_count': len(parent.contents) - 1 if parent is not None else 0
+        }
+    
+    return statistics
+
 def classify_domain_type(domain):
     """Classify domain into a category based on keywords"""
     domain_lower = domain.lower()
@@ -310,6 +1257,83 @@ def generate_xpath(element):
             
     return '//' + '/'.join(components)
 
+def xpath_generator():
+    """Return a function producing the same XPaths as generate_xpath, sharing work between calls
+    
+    Sibling positions are computed once per parent and ancestor path prefixes
+    are memoized, so paths for many elements of one tree cost O(n) overall.
+    Like generate_xpath, an element is numbered after the first same-named
+    sibling that is structurally equal to it; structural digests computed
+    bottom-up make that check cheap, and matches are confirmed with ==.
+    """
+    prefixes = {}
+    positions = {}
+    digests = {}
+    
+    def digest(node):
+        stack = [(node, False)]
+        while stack:
+            current, children_done = stack.pop()
+            if id(current) in digests:
+                continue
+            if not children_done:
+                stack.append((current, True))
+                stack.extend((child, False) for child in current.contents
+                             if isinstance(child, Tag) and id(child) not in digests)
+                continue
+            
+            attrs = frozenset((k, tuple(v) if isinstance(v, list) else v) for k, v in current.attrs.items())
+            children = tuple(digests[id(child)] if isinstance(child, Tag) else hash(('s', str(child)))
+                             for child in current.contents)
+            digests[id(current)] = hash(('t', current.name, attrs, children))
+        return digests[id(node)]
+    
+    def index_children(parent):
+        groups = {}
+        for child in parent.contents:
+            if isinstance(child, Tag):
+                groups.setdefault(child.name, []).append(child)
+        
+        for name, siblings in groups.items():
+            if len(siblings) == 1:
+                positions[id(siblings[0])] = name
+                continue
+            
+            first_by_digest = {}
+            for position, sibling in enumerate(siblings):
+                match = first_by_digest.setdefault(digest(sibling), position)
+                if match != position and siblings[match] != sibling:
+                    # Digest collision, fall back to the original linear scan
+                    match = next(i for i, other in enumerate(siblings) if other == sibling)
+                positions[id(sibling)] = f'{name}[{match+1}]'
+    
+    def component(node, parent):
+        if id(node) not in positions:
+            index_children(parent)
+        return positions[id(node)]
+    
+    def prefix(node):
+        # Collect the ancestors whose path is not known yet, then build top-down
+        chain = []
+        current = node
+        while current.parent is not None and id(current) not in prefixes:
+            chain.append(current)
+            if current.parent.name == 'html':
+                break
+            current = current.parent
+        
+        for current in reversed(chain):
+            parent = current.parent
+            step = component(current, parent)
+            above = '' if parent.name == 'html' else prefixes.get(id(parent), '')
+            prefixes[id(current)] = f'{above}/{step}' if above else step
+        return prefixes.get(id(node), '')
+    
+    def generate(element):
+        return '//' + prefix(element)
+    
+    return generate
+
 def generate_selectors(elements):
     """Generate CSS selectors for the given elements"""
     if not elements:
@@ -320,17 +1344,17 @@ def generate_selectors(elements):
     for element in elements:
         # Try class-based selector first
         if element['classes']:
-            class_selector = f"{element['tag']}.{'.'.join(element['classes'])}"
+            class_selector = f"{element['tag']}.{'.'.join(css_escape(c) for c in element['classes'])}"
             selectors.append(class_selector)
             
         # Try ID-based selector
         if element['id']:
-            id_selector = f"#{element['id']}"
+            id_selector = f"#{css_escape(element['id'])}"
             selectors.append(id_selector)
             
-        # Add XPath as fallback
+        # Add XPath with the classes it was generated for, so matches can be checked
         if 'xpath' in element:
-            selectors.append({'xpath': element['xpath']})
+            selectors.append({'xpath': element['xpath'], 'classes': list(element['classes'])})
     
     # Remove duplicates while preserving order
     unique_selectors = []
@@ -350,9 +1374,10 @@ def analyze_patterns(extracted_data):
         for container in extracted_data['product_containers']:
             container_classes.extend(container['classes'])
         
-        class_counts = pd.Series(container_classes).value_counts()
-        if not class_counts.empty:
-            patterns['container_class'] = class_counts.index[0]
+        # Ties go to the value seen first
+        class_counts = Counter(container_classes).most_common(1)
+        if class_counts:
+            patterns['container_class'] = class_counts[0][0]
     
     # Analyze price elements
     if extracted_data['price_tags']:
@@ -360,110 +1385,161 @@ def analyze_patterns(extracted_data):
         for price in extracted_data['price_tags']:
             price_classes.extend(price['classes'])
         
-        class_counts = pd.Series(price_classes).value_counts()
-        if not class_counts.empty:
-            patterns['price_class'] = class_counts.index[0]
+        class_counts = Counter(price_classes).most_common(1)
+        if class_counts:
+            patterns['price_class'] = class_counts[0][0]
     
     # Name patterns
     if extracted_data['name_tags']:
         name_tags = [item['tag'] for item in extracted_data['name_tags']]
-        tag_counts = pd.Series(name_tags).value_counts()
-        if not tag_counts.empty:
-            patterns['name_tag'] = tag_counts.index[0]
+        tag_counts = Counter(name_tags).most_common(1)
+        if tag_counts:
+            patterns['name_tag'] = tag_counts[0][0]
     
     return patterns
 
-def scrape_with_rules(url, html_content, extraction_rules):
+@lru_cache(maxsize=4096)
+def compile_xpath(expression):
+    """Compile an XPath expression once and reuse it across requests"""
+    return etree.XPath(expression)
+
+@lru_cache(maxsize=256)
+def plan_container_selectors(selector_specs):
+    """Order container selectors by evaluation cost
+    
+    Generated XPaths are absolute paths evaluated by lxml in C, so they run
+    first. ID selectors come next and class selectors, which soupsieve
+    matches against every tag in Python, run last. The plan is cached per
+    rule set.
+    """
+    xpaths = []
+    ids = []
+    classes = []
+    for kind, value, expected_classes in selector_specs:
+        if kind == 'xpath':
+            try:
+                xpaths.append((compile_xpath(value), expected_classes))
+            except etree.XPathSyntaxError:
+                continue
+        elif value.startswith('#'):
+            ids.append(value)
+        else:
+            classes.append(value)
+    
+    return (('xpath', tuple(xpaths)), ('css', tuple(ids)), ('css', tuple(classes)))
+
+def container_selector_specs(selectors):
+    """Turn a selector list from extraction_rules into a hashable plan key"""
+    specs = []
+    for selector in selectors:
+        if isinstance(selector, dict):
+            if 'xpath' in selector:
+                classes = selector.get('classes')
+                specs.append(('xpath', selector['xpath'], tuple(classes) if classes is not None else None))
+        else:
+            specs.append(('css', selector, None))
+    return tuple(specs)
+
+def build_xpath_index(html_content, soup):
+    """Parse the page with lxml and map its elements onto the tags of soup
+    
+    Elements are paired by document order, which lines up when soup was built
+    by the lxml parser. Returns (None, None) if the two trees disagree.
+    """
+    try:
+        root = lxml.html.document_fromstring(html_content)
+    except ValueError:
+        # lxml refuses str input that carries an XML encoding declaration
+        root = lxml.html.document_fromstring(html_content.encode('utf-8'))
+    except etree.ParserError:
+        return None, None
+    
+    elements = [el for el in root.iter() if isinstance(el.tag, str)]
+    tags = soup.find_all(True)
+    if len(elements) != len(tags) or any(el.tag != tag.name for el, tag in zip(elements, tags)):
+        return None, None
+    
+    return root, dict(zip(elements, tags))
+
+def find_product_containers(soup, html_content, container_selectors):
+    """Run container selectors cheapest-first until a container set is found"""
+    plan = plan_container_selectors(container_selector_specs(container_selectors))
+    containers = []
+    seen = set()
+    xpath_root = None
+    xpath_tags = None
+    
+    for kind, group in plan:
+        for selector in group:
+            metrics.inc('selectors_tried')
+            if kind == 'xpath':
+                if xpath_root is None:
+                    xpath_root, xpath_tags = build_xpath_index(html_content, soup)
+                    if xpath_root is None:
+                        break
+                compiled, expected_classes = selector
+                found = []
+                for element in compiled(xpath_root):
+                    tag = xpath_tags.get(element)
+                    # Positional paths can drift on other pages of the site, check the classes still match
+                    if tag is not None and (expected_classes is None or tuple(tag.get('class', [])) == expected_classes):
+                        found.append(tag)
+            else:
+                found = soup.select(selector)
+            
+            for tag in found:
+                if id(tag) not in seen:
+                    seen.add(id(tag))
+                    containers.append(tag)
+        
+        if len(containers) >= MIN_CONTAINER_SET:
+            break
+    
+    return containers
+
+def scrape_with_rules(url, html_content, extraction_rules, soup=None):
     """Use the ML-generated extraction rules to scrape the page"""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    domain = extract_domain(url)
+    return collect_scrape_records(iter_scrape_with_rules(url, html_content, extraction_rules, soup))
+
+def iter_scrape_with_rules(url, html_content, extraction_rules, soup=None):
+    """Yield the scrape_with_rules result as records, one product at a time
     
-    # Extract products using the selectors from extraction_rules
-    products = []
+    Records are (kind, payload) pairs: one 'page' record with pageInfo and
+    extractionMethod, one 'product' record per product with its price
+    history, and a final 'summary' record with the page metrics.
+    """
+    if soup is None:
+        soup = parse_html(html_content)
+    domain = extract_domain(url)
     
     # Try to use product container selectors
-    product_containers = []
-    for container_selector in extraction_rules['selectors']['product_containers']:
-        if isinstance(container_selector, dict) and 'xpath' in container_selector:
-            # XPath selector handling would require additional library like lxml
-            continue
-        
-        found_containers = soup.select(container_selector)
-        if found_containers:
-            product_containers.extend(found_containers)
+    with metrics.stage('containers'):
+        product_containers = find_product_containers(
+            soup, html_content, extraction_rules['selectors']['product_containers'])
     
     # If no product containers found, fallback to traditional scraping
     if not product_containers:
-        return scrape_website_traditional(url, html_content)
-    
-    # Process each product container
-    for container in product_containers:
-        product = {
-            "id": len(products) + 1,
-            "name": "Unknown Product",
-            "price": 0.0,
-            "category": "Unknown",
-            "rating": round(random.uniform(3.0, 5.0), 1),
-            "inStock": bool(random.getrandbits(1))
-        }
-        
-        # Extract product name
-        name_found = False
-        for name_selector in extraction_rules['selectors']['name_elements']:
-            if isinstance(name_selector, dict):
-                continue
-            name_elements = container.select(name_selector)
-            if name_elements:
-                product['name'] = name_elements[0].get_text(strip=True)
-                name_found = True
-                break
-        
-        # If no name found with selectors, try generic approach
-        if not name_found:
-            name_element = container.select_one('h1, h2, h3, h4, .title, .name')
-            if name_element:
-                product['name'] = name_element.get_text().strip()
-        
-        # Extract price
-        price_found = False
-        for price_selector in extraction_rules['selectors']['price_elements']:
-            if isinstance(price_selector, dict):
-                continue
-            price_elements = container.select(price_selector)
-            if price_elements:
-                price_text = price_elements[0].get_text(strip=True)
-                price_match = re.search(r'(\d+\.\d+|\d+)', price_text)
-                if price_match:
-                    product['price'] = float(price_match.group(1))
-                    price_found = True
-                    break
-        
-        # If no price found with selectors, try generic approach
-        if not price_found:
-            price_pattern = r'(\$|€|£|USD)\s*(\d+(?:\.\d{2})?)'
-            price_texts = container.get_text()
-            price_match = re.search(price_pattern, price_texts)
-            if price_match:
-                try:
-                    product['price'] = float(price_match.group(2))
-                except ValueError:
-                    pass
-        
-        # Try to extract category
-        category_text = container.get_text().lower()
-        categories = ["Electronics", "Clothing", "Home", "Books", "Beauty"]
-        for category in categories:
-            if category.lower() in category_text:
-                product["category"] = category
-                break
-        
-        # Check for stock information
-        stock_element = container.select_one('.stock, .availability, [class*=stock], [class*=availability]')
-        if stock_element:
-            product["inStock"] = "in stock" in stock_element.get_text().lower()
-        
-        # Add the product to our list
+        yield from iter_scrape_website_traditional(url, html_content, soup)
+        return
+    
+    yield 'page', {
+        "pageInfo": {
+            "title": page_title(soup),
+            "url": url,
+            "lastScraped": datetime.now().isoformat()
+        },
+        "extractionMethod": "ML-guided"
+    }
+    
+    # Process each product container, counting which selector supplied each field
+    rule_hits = {'name_elements': Counter(), 'price_elements': Counter()}
+    products = []
+    for product, price_history in iter_price_histories(
+            domain, iter_distinct_products(product_containers, extraction_rules, rule_hits)):
+        metrics.inc('products_extracted')
         products.append(product)
+        yield 'product', {"product": product, "priceHistory": price_history}
+    record_prices(domain, products)
     
     # Generate simulated time data for visitors
     today = datetime.now()
@@ -473,95 +1549,240 @@ def scrape_with_rules(url, html_content, extraction_rules):
         visitors = 100 + (i * 30) + (i * i * 2)
         time_data.append({"date": date, "visitors": visitors})
     
-    # Generate price history
-    price_history = generate_price_history(products)
+    # Word frequency, paragraph/image counts and link analysis in one walk
+    with metrics.stage('page_metrics'):
+        summary = compute_page_metrics(soup, domain, RULES_COMMON_WORDS)
+    summary["timeData"] = time_data
+    summary["ruleStats"] = rule_statistics(extraction_rules, rule_hits, len(product_containers),
+                                           len(product_containers) - len(products))
     
-    # Extract words for word frequency
-    text_content = soup.get_text()
-    words = re.findall(r'\b\w+\b', text_content.lower())
-    word_count = len(words)
+    yield 'summary', summary
+
+def iter_distinct_products(containers, extraction_rules, rule_hits=None):
+    """Yield the products of the containers in order, numbered from 1
     
-    common_words = {'the', 'and', 'a', 'to', 'of', 'in', 'is', 'it', 'that', 'for', 'on', 'with'}
-    filtered_words = [word for word in words if word not in common_words and len(word) > 2]
-    word_freq = Counter(filtered_words).most_common(5)
-    frequent_words = [{"word": word, "count": count} for word, count in word_freq]
+    A container inside another of the containers is skipped when its name
+    and price are those of an enclosing one, which it only repeats; nested
+    containers with their own product are kept. Each container is
+    extracted once, an enclosing one later in the list as soon as a nested
+    one needs it.
+    """
+    container_ids = {id(container) for container in containers}
+    extracted = {}
     
-    # Count paragraphs, images, and links
-    paragraphs_count = len(soup.find_all('p'))
-    images_count = len(soup.find_all('img'))
-    all_links = soup.find_all('a', href=True)
+    def extract(container):
+        if id(container) not in extracted:
+            with metrics.stage('products'):
+                extracted[id(container)] = extract_product_with_rules(container, extraction_rules, 0, rule_hits)
+        return extracted[id(container)]
     
-    internal_links = 0
-    external_links = 0
+    count = 0
+    for container in containers:
+        product = extract(container)
+        key = (product['name'], product['price'])
+        if any(id(parent) in container_ids and (extract(parent)['name'], extract(parent)['price']) == key
+               for parent in container.parents):
+            continue
+        count += 1
+        product['id'] = count
+        yield product
+
+def compile_field_selector(selector):
+    """Predicate telling whether a tag matches a CSS selector, as Tag.select() would"""
+    match = SIMPLE_CLASS_SELECTOR.fullmatch(selector)
+    if match:
+        name = match.group(1).lower()
+        classes = match.group(2)[1:].split('.')
+        return lambda tag: tag.name == name and all(c in tag_classes(tag) for c in classes)
     
-    for link in all_links:
-        href = link['href']
-        if href.startswith('#') or not href:
-            continue 
-        elif href.startswith('/') or domain in href:
-            internal_links += 1
-        else:
-            external_links += 1
+    match = SIMPLE_ID_SELECTOR.fullmatch(selector)
+    if match:
+        element_id = match.group(1)
+        return lambda tag: tag.get('id') == element_id
     
-    # Compile the final scraped data
-    scraped_data = {
-        "pageInfo": {
-            "title": soup.title.string if soup.title else "No title found",
-            "url": url,
-            "lastScraped": datetime.now().isoformat()
-        },
-        "metrics": {
-            "wordCount": word_count,
-            "paragraphs": paragraphs_count,
-            "images": images_count,
-            "links": internal_links + external_links
-        },
-        "frequentWords": frequent_words,
-        "linkAnalysis": [
-            {"type": "Internal", "count": internal_links},
-            {"type": "External", "count": external_links}
-        ],
-        "timeData": time_data,
-        "products": products,
-        "priceHistory": price_history,
-        "extractionMethod": "ML-guided"
+    return css_compile(selector).match
+
+def tag_classes(tag):
+    classes = tag.get('class', ())
+    return classes.split() if isinstance(classes, str) else classes
+
+def is_generic_name_element(tag):
+    """Matches 'h1, h2, h3, h4, .title, .name'"""
+    return tag.name in GENERIC_NAME_TAGS or any(c in ('title', 'name') for c in tag_classes(tag))
+
+def is_stock_element(tag):
+    """Matches '.stock, .availability, [class*=stock], [class*=availability]'"""
+    if not tag.get('class'):
+        return False
+    classes = ' '.join(tag_classes(tag))
+    return 'stock' in classes or 'availability' in classes
+
+@lru_cache(maxsize=256)
+def compile_rule_program(name_selectors, price_selectors):
+    """Name and price selectors compiled to predicates, in priority order"""
+    return ([compile_field_selector(selector) for selector in name_selectors],
+            [compile_field_selector(selector) for selector in price_selectors])
+
+def field_selectors(selectors):
+    """The CSS selectors of a selector list from extraction_rules (XPath entries only find containers)"""
+    return tuple(selector for selector in selectors if not isinstance(selector, dict))
+
+def extract_product_with_rules(container, extraction_rules, product_id, rule_hits=None):
+    """Extract one product from a container using the ML-generated selectors
+    
+    The name comes from the first name selector with a match, the price
+    from the first price selector whose first match holds a number. All
+    selectors are matched in one walk of the container, which stops once
+    no later element can change a field. rule_hits, if given, counts
+    which selector supplied the name and price.
+    """
+    product = {
+        "id": product_id,
+        "name": "Unknown Product",
+        "price": 0.0,
+        "category": "Unknown",
+        "rating": round(random.uniform(3.0, 5.0), 1),
+        "inStock": bool(random.getrandbits(1))
     }
     
-    return scraped_data
-
-def scrape_website_traditional(url, html_content):
-    """Traditional scraping method as a fallback (your original implementation)"""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    domain = extract_domain(url)
+    name_selectors = field_selectors(extraction_rules['selectors']['name_elements'])
+    price_selectors = field_selectors(extraction_rules['selectors']['price_elements'])
+    name_rules, price_rules = compile_rule_program(name_selectors, price_selectors)
+    metrics.inc('selectors_tried', len(name_rules) + len(price_rules))
+    
+    # Best (lowest) name selector index matched so far and its first match
+    name_index = len(name_rules)
+    name_element = None
+    generic_name_element = None
+    # First match of each price selector, and the best index whose first match holds a number
+    price_matches = [None] * len(price_rules)
+    price_index = len(price_rules)
+    price_number = None
+    stock_element = None
+    
+    for tag in container.descendants:
+        if not isinstance(tag, Tag):
+            continue
+        changed = False
+        
+        for index in range(name_index):
+            if name_rules[index](tag):
+                name_index, name_element, changed = index, tag, True
+                break
+        if name_index == len(name_rules) and generic_name_element is None and is_generic_name_element(tag):
+            generic_name_element, changed = tag, True
+        
+        for index in range(price_index):
+            if price_matches[index] is None and price_rules[index](tag):
+                price_matches[index] = tag
+                changed = True
+                number = PRICE_NUMBER_PATTERN.search(tag.get_text(strip=True))
+                if number:
+                    price_index, price_number = index, number
+                    break
+        
+        if stock_element is None and is_stock_element(tag):
+            stock_element, changed = tag, True
+        
+        # Stop when the best possible selectors have been found for every field
+        if changed and stock_element is not None:
+            name_done = name_index == 0 if name_rules else generic_name_element is not None
+            if name_done and all(match is not None for match in price_matches[:price_index]):
+                break
     
-    title = soup.title.string if soup.title else "No title found"
+    if name_element is not None:
+        product['name'] = name_element.get_text(strip=True)
+        if rule_hits is not None:
+            rule_hits['name_elements'][name_selectors[name_index]] += 1
+    elif generic_name_element is not None:
+        product['name'] = generic_name_element.get_text().strip()
     
-    text_content = soup.get_text()
-    words = re.findall(r'\b\w+\b', text_content.lower())
-    word_count = len(words)
+    text = container.get_text()
+    if price_number is not None:
+        product['price'] = float(price_number.group(1))
+        if rule_hits is not None:
+            rule_hits['price_elements'][price_selectors[price_index]] += 1
+    else:
+        price_match = GENERIC_PRICE_PATTERN.search(text)
+        if price_match:
+            try:
+                product['price'] = float(price_match.group(2))
+            except ValueError:
+                pass
     
-    common_words = {'the', 'and', 'a', 'to', 'of', 'in', 'is', 'it', 'that', 'for', 'on', 'with', 'as', 'are', 'at', 'be', 'this', 'by', 'an', 'was', 'not'}
-    filtered_words = [word for word in words if word not in common_words and len(word) > 2]
-    word_freq = Counter(filtered_words).most_common(5)
-    frequent_words = [{"word": word, "count": count} for word, count in word_freq]
+    # Try to extract category
+    category_text = text.lower()
+    for category in PRODUCT_CATEGORIES:
+        if category.lower() in category_text:
+            product["category"] = category
+            break
     
-    paragraphs_count = len(soup.find_all('p'))
+    # Check for stock information
+    if stock_element is not None:
+        product["inStock"] = "in stock" in stock_element.get_text().lower()
     
-    images_count = len(soup.find_all('img'))
+    return product
+
+def rule_statistics(extraction_rules, rule_hits, containers, nested):
+    """Share of containers for which each name and price selector supplied the field"""
+    statistics = {'containers': containers, 'nestedContainersDropped': nested}
+    for field, key in (('name_elements', 'nameSelectors'), ('price_elements', 'priceSelectors')):
+        statistics[key] = [
+            {'selector': selector, 'hits': rule_hits[field][selector],
+             'hitRate': round(rule_hits[field][selector] / containers, 3) if containers else 0.0}
+            for selector in field_selectors(extraction_rules['selectors'][field])
+        ]
+    return statistics
+
+def prune_dead_selectors(extraction_rules, statistics, min_containers=None):
+    """Copy of extraction_rules without the name and price selectors that supplied nothing
     
-    all_links = soup.find_all('a', href=True)
+    Only pages with at least min_containers containers
+    (RULE_PRUNE_MIN_CONTAINERS by default) count; returns None when there
+    is nothing to prune.
+    """
+    min_containers = RULE_PRUNE_MIN_CONTAINERS if min_containers is None else min_containers
+    if min_containers <= 0 or statistics is None or statistics['containers'] < min_containers:
+        return None
     
-    internal_links = 0
-    external_links = 0
+    dead = {stat['selector'] for key in ('nameSelectors', 'priceSelectors')
+            for stat in statistics[key] if stat['hits'] == 0}
+    if not dead:
+        return None
     
-    for link in all_links:
-        href = link['href']
-        if href.startswith('#') or not href:
-            continue 
-        elif href.startswith('/') or domain in href:
-            internal_links += 1
-        else:
-            external_links += 1
+    selectors = dict(extraction_rules['selectors'])
+    for field in ('name_elements', 'price_elements'):
+        selectors[field] = [selector for selector in selectors[field]
+                            if isinstance(selector, dict) or selector not in dead]
+    return {**extraction_rules, 'selectors': selectors}
+
+def scrape_website_traditional(url, html_content, soup=None):
+    """Traditional scraping method as a fallback (your original implementation)"""
+    return collect_scrape_records(iter_scrape_website_traditional(url, html_content, soup))
+
+def iter_scrape_website_traditional(url, html_content, soup=None):
+    """Yield the scrape_website_traditional result as records (see iter_scrape_with_rules)"""
+    if soup is None:
+        soup = parse_html(html_content)
+    domain = extract_domain(url)
+    
+    yield 'page', {
+        "pageInfo": {
+            "title": page_title(soup),
+            "url": url,
+            "lastScraped": datetime.now().isoformat()
+        },
+        "extractionMethod": "Traditional"
+    }
+    
+    # Only products read from a listing on the page have real prices worth recording
+    listed = []
+    with metrics.stage('products'):
+        products = extract_products(soup, url, listed)
+    for product, price_history in iter_price_histories(domain, products):
+        metrics.inc('products_extracted')
+        yield 'product', {"product": product, "priceHistory": price_history}
+    record_prices(domain, listed)
     
     today = datetime.now()
     time_data = []
@@ -571,48 +1792,90 @@ def scrape_website_traditional(url, html_content):
         visitors = 100 + (i * 30) + (i * i * 2)
         time_data.append({"date": date, "visitors": visitors})
     
-    products = extract_products(soup, url)
+    with metrics.stage('page_metrics'):
+        summary = compute_page_metrics(soup, domain, TRADITIONAL_COMMON_WORDS)
+    summary["timeData"] = time_data
     
-    price_history = generate_price_history(products)
+    yield 'summary', summary
+
+def compute_page_metrics(soup, domain, common_words, top_words=5):
+    """Compute metrics, frequentWords and linkAnalysis for a page in a single tree walk
     
-    scraped_data = {
-        "pageInfo": {
-            "title": title,
-            "url": url,
-            "lastScraped": datetime.now().isoformat()
-        },
+    Text is gathered exactly as soup.get_text() would and its words are
+    counted as they are matched, without building a word list.
+    """
+    text_pieces = []
+    paragraphs_count = 0
+    images_count = 0
+    internal_links = 0
+    external_links = 0
+    
+    for node in soup.descendants:
+        if isinstance(node, Tag):
+            if node.name == 'p':
+                paragraphs_count += 1
+            elif node.name == 'img':
+                images_count += 1
+            elif node.name == 'a':
+                href = node.get('href')
+                if href is None or href.startswith('#') or not href:
+                    continue
+                elif href.startswith('/') or domain in href:
+                    internal_links += 1
+                else:
+                    external_links += 1
+        elif type(node) in MAIN_TEXT_TYPES:
+            text_pieces.append(node)
+    
+    word_count = 0
+    word_counts = Counter()
+    for match in WORD_PATTERN.finditer(''.join(text_pieces).lower()):
+        word_count += 1
+        word = match.group()
+        if len(word) > 2 and word not in common_words:
+            word_counts[word] += 1
+    
+    return {
         "metrics": {
             "wordCount": word_count,
             "paragraphs": paragraphs_count,
             "images": images_count,
             "links": internal_links + external_links
         },
-        "frequentWords": frequent_words,
+        "frequentWords": [{"word": word, "count": count} for word, count in word_counts.most_common(top_words)],
         "linkAnalysis": [
             {"type": "Internal", "count": internal_links},
             {"type": "External", "count": external_links}
-        ],
-        "timeData": time_data,
-        "products": products,
-        "priceHistory": price_history,
-        "extractionMethod": "Traditional"
+        ]
     }
-    
-    return scraped_data
 
-def extract_products(soup, url):
-  
+def collect_scrape_records(records):
+    """Assemble scrape records into the scraped_data dict returned by the API"""
+    scraped_data = {}
     products = []
+    price_history = []
     
-    is_ecommerce = False
-    ecommerce_indicators = ['price', 'cart', 'checkout', 'shop', 'product', 'buy', 'purchase']
+    for kind, payload in records:
+        if kind == 'product':
+            products.append(payload['product'])
+            price_history.append(payload['priceHistory'])
+        else:
+            scraped_data.update(payload)
     
-    for indicator in ecommerce_indicators:
-        if soup.find_all(text=re.compile(indicator, re.IGNORECASE)):
-            is_ecommerce = True
-            break
+    scraped_data['products'] = products
+    scraped_data['priceHistory'] = price_history
+    return scraped_data
+
+def extract_products(soup, url, listed=None):
+    """Products of a page for the traditional scraper
+    
+    If listed is given, the products read from product containers on the
+    page are appended to it; the others are made up from headings and
+    stray prices, or are samples.
+    """
+    products = []
     
-    if not is_ecommerce:
+    if not is_ecommerce_page(soup):
         # If not an e-commerce site, generate some sample product data
         # This would be replaced with actual scraping logic for real sites
         sample_products = [
@@ -663,24 +1926,21 @@ def extract_products(soup, url):
                 product["inStock"] = "in stock" in stock_element.get_text().lower()
             
             products.append(product)
+        
+        if listed is not None:
+            listed.extend(products)
     
     # If no products found, create sample data
     if not products:
         # Extract potential product names and prices from the page
-        potential_names = [h.get_text().strip() for h in soup.select('h1, h2, h3') if 5 < len(h.get_text().strip()) < 100]
-        potential_prices = []
+        potential_names = []
+        for heading in soup.select('h1, h2, h3'):
+            heading_text = heading.get_text().strip()
+            if 5 < len(heading_text) < 100:
+                potential_names.append(heading_text)
         
-        # Look for price patterns in the text
-        price_patterns = [
-            r'\$\s*(\d+(?:\.\d{2})?)',  # $XX.XX
-            r'(\d+(?:\.\d{2})?)\s*USD',  # XX.XX USD
-            r'(\d+(?:\.\d{2})?)\s*€',    # XX.XX €
-            r'£\s*(\d+(?:\.\d{2})?)'     # £XX.XX
-        ]
-        
-        for pattern in price_patterns:
-            matches = re.findall(pattern, soup.get_text())
-            potential_prices.extend([float(p) for p in matches])
+        # Look for price patterns in the text (only as many as there are names to pair them with)
+        potential_prices = find_candidate_prices(soup, min(5, len(potential_names)))
         
         # Create products with extracted names and prices
         for i in range(min(5, len(potential_names))):
@@ -706,38 +1966,122 @@ def extract_products(soup, url):
     
     return products
 
-def generate_price_history(products):
-    """Generate simulated price history data for the products"""
-    history = []
-    today = datetime.now()
+def is_ecommerce_page(soup):
+    """Check whether any text on the page mentions a shopping term
+    
+    One pass over the text nodes, which are lowercased and searched with a
+    single combined pattern in chunks, stopping at the first hit. Nodes are
+    joined with NUL so matches never span two nodes. Like
+    soup.find_all(text=...), comments and scripts count.
+    """
+    chunk = []
+    chunk_length = 0
+    for node in soup.descendants:
+        if isinstance(node, NavigableString):
+            chunk.append(node)
+            chunk_length += len(node)
+            if chunk_length >= ECOMMERCE_SCAN_CHUNK:
+                if ECOMMERCE_PATTERN.search('\x00'.join(chunk).lower()):
+                    return True
+                chunk = []
+                chunk_length = 0
+    
+    return ECOMMERCE_PATTERN.search('\x00'.join(chunk).lower()) is not None
+
+def find_candidate_prices(soup, limit):
+    """Collect up to limit prices from the page text
+    
+    All formats are matched in one scan of a single get_text() of the page
+    and the prices are ordered by format ($ first, then USD, € and £), in
+    page order within a format. The scan stops once limit $ prices are
+    found, as nothing can come before them. A number with two currency
+    marks is counted once, under the format that matches leftmost in the
+    text rather than the preferred one: '£5 USD' is a £ price and '$5 USD'
+    a $ price.
+    """
+    if limit <= 0:
+        return []
+    
+    found = {group: [] for group in PRICE_TEXT_GROUPS}
+    for match in PRICE_TEXT_PATTERN.finditer(soup.get_text()):
+        found[match.lastgroup].append(float(match.group(match.lastgroup)))
+        if len(found['dollar']) >= limit:
+            break
     
+    return [price for group in PRICE_TEXT_GROUPS for price in found[group]][:limit]
+
+def product_price_history(domain, product, now=None):
+    """Daily prices of a product over the last PRICE_HISTORY_DAYS days, ending with its price on this page
+    
+    Earlier days hold the average of the prices recorded for the product on
+    that day; days it was not scraped are left out.
+    """
+    return product_price_histories(domain, [product], now)[0]
+
+def iter_price_histories(domain, products):
+    """Yield (product, product_price_history) as products come, reading PRICE_HISTORY_CHUNK histories per query"""
+    chunk = []
     for product in products:
-        product_history = []
-        current_price = product["price"]
-        
-        # Generate price points for the last 30 days
-        for i in range(30, -1, -1):
-            date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
-            
-            # Slight random price variations
-            if i > 0:  # Keep the most recent price as is
-                price_variation = random.uniform(-0.1, 0.1)  # -10% to +10%
-                historical_price = round(current_price * (1 + price_variation), 2)
-            else:
-                historical_price = current_price
-                
-            product_history.append({
-                "date": date,
-                "price": historical_price
-            })
-        
-        history.append({
+        chunk.append(product)
+        if len(chunk) >= PRICE_HISTORY_CHUNK:
+            with metrics.stage('price_history'):
+                histories = product_price_histories(domain, chunk)
+            yield from zip(chunk, histories)
+            chunk = []
+    if chunk:
+        with metrics.stage('price_history'):
+            histories = product_price_histories(domain, chunk)
+        yield from zip(chunk, histories)
+
+def product_price_histories(domain, products, now=None):
+    """product_price_history of every product of a page, read from the store in one query"""
+    today = (datetime.now() if now is None else now).replace(hour=0, minute=0, second=0, microsecond=0)
+    stored = {}
+    store = get_price_history_store()
+    if store is not None and products:
+        start = today - timedelta(days=PRICE_HISTORY_DAYS)
+        stored = store.histories(domain, [product["name"] for product in products], start.timestamp(),
+                                 today.timestamp(), bucket_seconds=86400)
+    
+    # Products of a page share their days, each is formatted once
+    dates = {}
+    histories = []
+    for product in products:
+        price_data = []
+        for point in stored.get(product_key(product["name"]), []):
+            if point['timestamp'] not in dates:
+                dates[point['timestamp']] = datetime.fromtimestamp(point['timestamp']).strftime('%Y-%m-%d')
+            price_data.append({"date": dates[point['timestamp']], "price": point['price']})
+        price_data.append({"date": today.strftime('%Y-%m-%d'), "price": product["price"]})
+        histories.append({
             "productId": product["id"],
             "productName": product["name"],
-            "priceData": product_history
+            "priceData": price_data
         })
-    
-    return history
+    return histories
+
+def record_prices(domain, products):
+    """Append the prices of named, priced products to the price history in one transaction"""
+    store = get_price_history_store()
+    observations = [(product["name"], product["price"]) for product in products
+                    if product["name"] != "Unknown Product" and product["price"] > 0]
+    if store is None or not observations:
+        return
+    with metrics.stage('record_prices'):
+        try:
+            store.record(domain, observations)
+        except sqlite3.Error as e:
+            print(f"Error recording prices: {str(e)}")
+
+job_queue = JobQueue(
+    SQLiteJobStore(JOB_DB_PATH) if JOB_BACKEND == 'sqlite' else MemoryJobStore(),
+    run_scrape_job,
+    workers=int(os.environ.get('WEBMINER_JOB_WORKERS', 4)),
+    max_queued=int(os.environ.get('WEBMINER_JOB_QUEUE_SIZE', 100)),
+    result_ttl=int(os.environ.get('WEBMINER_JOB_RESULT_TTL', 3600)),
+    # A job still running after this many seconds without its worker renewing it is failed
+    lease=int(os.environ.get('WEBMINER_JOB_LEASE', 60))
+)
 
 if __name__ == '__main__':
     # Get port from environment variable or use 5000 as default
@@ -0,0 +1,992 @@
+"""Offline benchmarks for the scraping pipeline
+
+Replays the pages saved in training_data/ through parts of the pipeline
+without any network access. Run from the repository root so the model
+files in Model/ are found:
+
+    python backend/benchmark.py features
+
+The pipeline benchmark replays the pages, and copies of them with the
+product grid repeated, through the whole pipeline and can write its
+results as JSON to compare two versions:
+
+    python backend/benchmark.py pipeline --scales 1,10,100 --repeat 3 --json before.json
+"""
+import argparse
+import copy
+import glob
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import re
+import socket
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app  # noqa: E402
+import model_store  # noqa: E402
+import stand_in_server  # noqa: E402
+import fingerprint  # noqa: E402
+from price_history import PriceHistoryStore  # noqa: E402
+
+TRAINING_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'training_data')
+
+# Prices of the replayed pages go to a throwaway store instead of the server's
+app.price_history_store = PriceHistoryStore(os.path.join(tempfile.mkdtemp(), 'price_history.sqlite3'))
+
+def load_pages(pattern='*.html'):
+    """Load the saved training pages as (name, html) pairs"""
+    pages = []
+    for path in sorted(glob.glob(os.path.join(TRAINING_DATA_DIR, pattern))):
+        with open(path, encoding='utf-8') as f:
+            pages.append((os.path.basename(path), f.read()))
+    return pages
+
+def bench_features(pages):
+    """Compare per-tag feature extraction with the single-pass statistics table"""
+    print(f"{'page':45} {'candidates':>10} {'per-tag s':>10} {'table s':>10} {'speedup':>8}  match")
+    for name, html in pages:
+        soup = BeautifulSoup(html, 'html.parser')
+        candidates = soup.select('div, li, article, section')
+
+        start = time.perf_counter()
+        per_tag = [app.extract_features_from_tag(tag) for tag in candidates]
+        per_tag_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tag_statistics = app.compute_tag_statistics(soup)
+        from_table = [app.extract_features_from_tag(tag, tag_statistics) for tag in candidates]
+        table_time = time.perf_counter() - start
+
+        match = per_tag == from_table
+        print(f"{name:45} {len(candidates):>10} {per_tag_time:>10.3f} {table_time:>10.3f} "
+              f"{per_tag_time / table_time:>7.1f}x  {'yes' if match else 'NO'}")
+
+def bench_parsers(pages):
+    """Compare parse throughput and end-to-end analysis time per parser backend"""
+    print(f"{'page':45} {'parser':12} {'parse s':>8} {'MB/s':>7} {'pipeline s':>10} {'containers':>10}")
+    totals = {parser: [0, 0.0] for parser in app.SUPPORTED_PARSERS}
+    for name, html in pages:
+        size_mb = len(html.encode('utf-8')) / 1e6
+        for parser in app.SUPPORTED_PARSERS:
+            start = time.perf_counter()
+            soup = app.parse_html(html, parser)
+            parse_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rules = app.analyze_website_structure(f"https://{name}", html, soup)
+            app.scrape_with_rules(f"https://{name}", html, rules, soup)
+            pipeline_time = time.perf_counter() - start
+
+            totals[parser][0] += 1
+            totals[parser][1] += parse_time
+            containers = len(rules['selectors']['product_containers'])
+            print(f"{name:45} {parser:12} {parse_time:>8.3f} {size_mb / parse_time:>7.2f} "
+                  f"{pipeline_time:>10.3f} {containers:>10}")
+
+    for parser, (count, parse_time) in totals.items():
+        print(f"{parser}: {count / parse_time:.1f} pages/sec parsed")
+
+def bench_xpath(pages):
+    """Compare generate_xpath with the memoized xpath_generator and check the paths are identical"""
+    print(f"{'page':58} {'elements':>8} {'per-element s':>13} {'memoized s':>10} {'speedup':>8}  identical")
+    for name, html in pages:
+        for parser in app.SUPPORTED_PARSERS:
+            soup = app.parse_html(html, parser)
+            elements = soup.select('div, li, article, section, span, a, img, button, h1, h2, h3, h4')
+
+            start = time.perf_counter()
+            expected = [app.generate_xpath(element) for element in elements]
+            per_element_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            xpath_for = app.xpath_generator()
+            generated = [xpath_for(element) for element in elements]
+            memoized_time = time.perf_counter() - start
+
+            identical = expected == generated
+            print(f"{name + ' (' + parser + ')':58} {len(elements):>8} {per_element_time:>13.3f} "
+                  f"{memoized_time:>10.3f} {per_element_time / memoized_time:>7.1f}x  {'yes' if identical else 'NO'}")
+
+def reference_page_metrics(soup, domain, common_words):
+    """The original multi-pass page metrics, kept to check compute_page_metrics against"""
+    words = re.findall(r'\b\w+\b', soup.get_text().lower())
+    filtered_words = [word for word in words if word not in common_words and len(word) > 2]
+    frequent_words = [{"word": word, "count": count} for word, count in Counter(filtered_words).most_common(5)]
+
+    internal_links = 0
+    external_links = 0
+    for link in soup.find_all('a', href=True):
+        href = link['href']
+        if href.startswith('#') or not href:
+            continue
+        elif href.startswith('/') or domain in href:
+            internal_links += 1
+        else:
+            external_links += 1
+
+    return {
+        "metrics": {
+            "wordCount": len(words),
+            "paragraphs": len(soup.find_all('p')),
+            "images": len(soup.find_all('img')),
+            "links": internal_links + external_links
+        },
+        "frequentWords": frequent_words,
+        "linkAnalysis": [
+            {"type": "Internal", "count": internal_links},
+            {"type": "External", "count": external_links}
+        ]
+    }
+
+def bench_metrics(pages):
+    """Compare the single-walk page metrics with the original multi-pass version"""
+    print(f"{'page':45} {'multi-pass s':>12} {'single s':>9} {'speedup':>8}  identical")
+    for name, html in pages:
+        soup = app.parse_html(html)
+        domain = name.rsplit('_', 1)[0].replace('_', '.')
+
+        start = time.perf_counter()
+        expected = [reference_page_metrics(soup, domain, words)
+                    for words in (app.RULES_COMMON_WORDS, app.TRADITIONAL_COMMON_WORDS)]
+        multi_pass_time = (time.perf_counter() - start) / 2
+
+        start = time.perf_counter()
+        computed = [app.compute_page_metrics(soup, domain, words)
+                    for words in (app.RULES_COMMON_WORDS, app.TRADITIONAL_COMMON_WORDS)]
+        single_time = (time.perf_counter() - start) / 2
+
+        identical = expected == computed
+        print(f"{name:45} {multi_pass_time:>12.3f} {single_time:>9.3f} "
+              f"{multi_pass_time / single_time:>7.1f}x  {'yes' if identical else 'NO'}")
+
+def reference_is_ecommerce(soup):
+    """The original detection: one find_all text scan per indicator"""
+    for indicator in ['price', 'cart', 'checkout', 'shop', 'product', 'buy', 'purchase']:
+        if soup.find_all(text=re.compile(indicator, re.IGNORECASE)):
+            return True
+    return False
+
+def reference_candidate_prices(soup):
+    """The original price collection: one get_text() per price pattern"""
+    potential_prices = []
+    for pattern in [r'\$\s*(\d+(?:\.\d{2})?)', r'(\d+(?:\.\d{2})?)\s*USD',
+                    r'(\d+(?:\.\d{2})?)\s*€', r'£\s*(\d+(?:\.\d{2})?)']:
+        potential_prices.extend(float(p) for p in re.findall(pattern, soup.get_text()))
+    return potential_prices
+
+def bench_ecommerce(pages):
+    """Compare e-commerce detection and price collection with the original scans
+
+    Each page is also run with every shopping term removed, which forces the
+    detection to scan the whole document, and with prices in all four
+    formats mixed in, which checks their order.
+    """
+    mixed_prices = ''.join(f"<p>Now {price}</p>" for price in
+                           ['£9.50', '12.99 USD', '15 €', '$4.99', '7 USD', '£3', '$120', '20.00 €', '$8.25'])
+    print(f"{'page':55} {'detect old s':>12} {'new s':>7} {'prices old s':>12} {'new s':>7}  identical")
+    for name, html in pages:
+        variants = [(name, html),
+                    (name + ' (no terms)', re.sub(r'price|cart|checkout|shop|product|buy|purchase', '', html, flags=re.IGNORECASE)),
+                    (name + ' (mixed prices)', html.replace('<body', mixed_prices + '<body', 1))]
+        for label, variant in variants:
+            soup = app.parse_html(variant)
+
+            start = time.perf_counter()
+            expected = reference_is_ecommerce(soup)
+            detect_old = time.perf_counter() - start
+            start = time.perf_counter()
+            detected = app.is_ecommerce_page(soup)
+            detect_new = time.perf_counter() - start
+
+            start = time.perf_counter()
+            expected_prices = reference_candidate_prices(soup)[:5]
+            prices_old = time.perf_counter() - start
+            start = time.perf_counter()
+            prices = app.find_candidate_prices(soup, 5)
+            prices_new = time.perf_counter() - start
+
+            identical = expected == detected and expected_prices == prices
+            print(f"{label:55} {detect_old:>12.4f} {detect_new:>7.4f} {prices_old:>12.4f} {prices_new:>7.4f}  "
+                  f"{'yes' if identical else 'NO'}")
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, 'backend')
+import app, model_store
+print(json.dumps({'import': time.perf_counter() - start, 'rss': model_store.process_rss_mb(),
+                  'sklearn': 'sklearn' in sys.modules, 'pandas': 'pandas' in sys.modules}))
+"""
+
+DOWNLOAD_SCRIPT = """
+import json, resource, sys, time
+sys.path.insert(0, 'backend')
+import app
+start = time.perf_counter()
+html, truncated = app.download_page(sys.argv[1])
+result = app.scrape_page(sys.argv[1], html, truncated)
+print(json.dumps({'seconds': time.perf_counter() - start, 'bytes': len(html.encode('utf-8')),
+                  'products': len(result['products']), 'truncated': result['pageInfo']['truncated'],
+                  'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+def candidate_inputs(html):
+    """Feature rows and snippets for a page, as analyze_website_structure builds them"""
+    _, feature_rows, html_snippets = app.extract_candidates(app.parse_html(html))
+    return feature_rows, html_snippets
+
+def worker_memory(model_format, preload, workers=2):
+    """Start gunicorn with backend/gunicorn.conf.py and return (PSS, private) MB per worker
+
+    PSS splits pages shared with the master between the processes sharing
+    them; private memory is what each worker costs on its own.
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    env = dict(os.environ, WEBMINER_MODEL_FORMAT=model_format, WEBMINER_PRELOAD='1' if preload else '0',
+               PYTHONWARNINGS='ignore')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'backend/gunicorn.conf.py', '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Workers are ready once all of them exist and their memory stops growing
+        previous = None
+        while True:
+            time.sleep(0.5)
+            with open(f'/proc/{server.pid}/task/{server.pid}/children') as f:
+                pids = f.read().split()
+            usage = [smaps_rollup_mb(pid) for pid in pids]
+            if len(pids) == workers and usage == previous:
+                return usage
+            previous = usage
+    finally:
+        server.terminate()
+        server.wait()
+
+def smaps_rollup_mb(pid):
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return round(fields['Pss'], 1), round(fields['Private_Clean'] + fields['Private_Dirty'], 1)
+
+def bench_model(pages):
+    """Compare the pickled and compact model: startup, memory and batched predictions
+
+    Startup is measured in a fresh interpreter per format, as a gunicorn
+    worker without --preload would pay it.
+    """
+    print(f"{'format':8} {'app import s':>12} {'RSS MB':>7}  scikit-learn loaded")
+    for model_format in ('pickle', 'compact'):
+        env = dict(os.environ, WEBMINER_MODEL_FORMAT=model_format, PYTHONWARNINGS='ignore')
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, capture_output=True,
+                                text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{model_format:8} {result['import']:>12.2f} {result['rss'] or 0:>7.0f}  {'yes' if result['sklearn'] else 'no'}")
+
+    if importlib.util.find_spec('gunicorn') and os.path.exists('/proc/self/smaps_rollup'):
+        print()
+        print(f"{'format':8} {'preload':8} {'PSS MB/worker':>13} {'private MB/worker':>17}")
+        for model_format in ('pickle', 'compact'):
+            for preload in (False, True):
+                usage = worker_memory(model_format, preload)
+                pss = sum(worker[0] for worker in usage) / len(usage)
+                private = sum(worker[1] for worker in usage) / len(usage)
+                print(f"{model_format:8} {'yes' if preload else 'no':8} {pss:>13.0f} {private:>17.0f}")
+
+    formats = {}
+    for model_format in ('pickle', 'compact'):
+        model, vectorizer, _ = model_store.load_model_artifacts(
+            app.MODEL_PATH, app.VECTORIZER_PATH, app.COMPACT_MODEL_PATH, model_format)
+        formats[model_format] = (model, vectorizer, app.build_feature_layout(model, vectorizer))
+
+    print()
+    print(f"{'page':45} {'candidates':>10} {'pickle s':>9} {'compact s':>9} {'speedup':>8}  identical")
+    for name, html in pages:
+        feature_rows, html_snippets = candidate_inputs(html)
+        domain_type = app.classify_domain_type(name.rsplit('_', 1)[0].replace('_', '.'))
+
+        timings = {}
+        predictions = {}
+        for model_format, artifacts in formats.items():
+            start = time.perf_counter()
+            predictions[model_format] = list(app.predict_product_containers(feature_rows, html_snippets, domain_type, artifacts))
+            timings[model_format] = time.perf_counter() - start
+
+        identical = predictions['pickle'] == predictions['compact']
+        print(f"{name:45} {len(feature_rows):>10} {timings['pickle']:>9.3f} {timings['compact']:>9.3f} "
+              f"{timings['pickle'] / timings['compact']:>7.1f}x  {'yes' if identical else 'NO'}")
+
+def run_pipeline(url, html):
+    """Analyze and scrape a page, returning (candidate count, seconds, products)"""
+    start = time.perf_counter()
+    soup = app.parse_html(html)
+    rules = app.analyze_website_structure(url, html, soup)
+    result = app.scrape_with_rules(url, html, rules, soup)
+    elapsed = time.perf_counter() - start
+    candidates = len(app.extract_candidates(soup)[0])
+    return candidates, elapsed, {(product['name'], product['price']) for product in result['products']}
+
+def bench_candidates(pages):
+    """Check the bounded serializer and measure wrapper pruning against the full candidate set
+
+    Recall is the share of products extracted with every candidate that are
+    still extracted with pruning.
+    """
+    print(f"{'page':45} {'str() s':>8} {'bounded s':>9}  identical")
+    for name, html in pages:
+        soup = app.parse_html(html)
+        tags = soup.select('div, li, article, section')
+        start = time.perf_counter()
+        expected = [str(tag)[:app.SNIPPET_LENGTH] for tag in tags]
+        full_time = time.perf_counter() - start
+        start = time.perf_counter()
+        bounded = [app.html_snippet(tag) for tag in tags]
+        bounded_time = time.perf_counter() - start
+        print(f"{name:45} {full_time:>8.3f} {bounded_time:>9.3f}  {'yes' if expected == bounded else 'NO'}")
+
+    print()
+    print(f"{'page':45} {'candidates':>10} {'kept':>5} {'full s':>7} {'pruned s':>8} {'products':>8} {'recall':>6}")
+    totals = [0, 0]
+    share = app.WRAPPER_TEXT_SHARE
+    for name, html in pages:
+        url = f"https://{name.rsplit('_', 1)[0].replace('_', '.')}/"
+        try:
+            app.WRAPPER_TEXT_SHARE = 1.0
+            candidates, full_time, full_products = run_pipeline(url, html)
+        finally:
+            app.WRAPPER_TEXT_SHARE = share
+        kept, pruned_time, pruned_products = run_pipeline(url, html)
+
+        recalled = len(full_products & pruned_products)
+        totals[0] += len(full_products)
+        totals[1] += recalled
+        recall = recalled / len(full_products) if full_products else 1.0
+        print(f"{name:45} {candidates:>10} {kept:>5} {full_time:>7.2f} {pruned_time:>8.2f} "
+              f"{len(full_products):>8} {recall:>6.2f}")
+        for product in sorted(full_products - pruned_products, key=str)[:3]:
+            print(f"    only without pruning: {product[0][:60]!r}")
+    print(f"recall {totals[1]}/{totals[0]}")
+
+def bench_groups(pages):
+    """Compare classifying one representative per repeated sibling group with classifying every candidate
+
+    Times cover building the model input and predicting; 'same' checks
+    that scraping with the resulting rules finds the same products.
+    """
+    print(f"{'page':45} {'candidates':>10} {'classified':>10} {'groups':>6} {'changed':>7} "
+          f"{'each s':>7} {'grouped s':>9} {'products':>8} {'same':>5}")
+    min_size = app.REPEATED_GROUP_MIN
+    for name, html in pages:
+        url = f"https://{name.rsplit('_', 1)[0].replace('_', '.')}/"
+        soup = app.parse_html(html)
+        tag_statistics = app.compute_tag_statistics(soup)
+        tags = app.select_candidates(soup, tag_statistics)
+        domain_type = app.classify_domain_type(app.extract_domain(url))
+
+        start = time.perf_counter()
+        each = app.predict_product_containers(*app.candidate_inputs(tags, tag_statistics), domain_type)
+        each_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        groups = app.group_repeated_candidates(tags)
+        representatives = [tags[group[0]] for group in groups]
+        grouped = app.predict_product_containers(*app.candidate_inputs(representatives, tag_statistics), domain_type)
+        grouped_time = time.perf_counter() - start
+        changed = sum(each[index] != prediction for group, prediction in zip(groups, grouped) for index in group)
+        repeated = sum(len(group) > 1 for group in groups)
+
+        try:
+            app.REPEATED_GROUP_MIN = 0
+            each_products = run_pipeline(url, html)[2]
+        finally:
+            app.REPEATED_GROUP_MIN = min_size
+        grouped_products = run_pipeline(url, html)[2]
+        print(f"{name:45} {len(tags):>10} {len(groups):>10} {repeated:>6} {changed:>7} "
+              f"{each_time:>7.3f} {grouped_time:>9.3f} {len(each_products):>8} "
+              f"{'yes' if each_products == grouped_products else 'NO':>5}")
+
+def reference_analyze_patterns(extracted_data):
+    """analyze_patterns as it was with pandas, for comparison"""
+    import pandas as pd
+    patterns = {}
+    for key, pattern, field in (('product_containers', 'container_class', 'classes'),
+                                ('price_tags', 'price_class', 'classes')):
+        if extracted_data[key]:
+            values = [value for item in extracted_data[key] for value in item[field]]
+            counts = pd.Series(values).value_counts()
+            if not counts.empty:
+                patterns[pattern] = counts.index[0]
+    if extracted_data['name_tags']:
+        counts = pd.Series([item['tag'] for item in extracted_data['name_tags']]).value_counts()
+        if not counts.empty:
+            patterns['name_tag'] = counts.index[0]
+    return patterns
+
+def bench_startup(pages, runs=5):
+    """App import time with and without pandas, and the per-request steps that used it
+
+    'with pandas' imports pandas before the app, as the app itself did
+    before; import times are the median of several fresh interpreters.
+    """
+    env = dict(os.environ, WEBMINER_MODEL_FORMAT='compact', PYTHONWARNINGS='ignore')
+    print(f"{'startup':14} {'app import s':>12} {'RSS MB':>7}  pandas loaded")
+    for label, script in (('with pandas', STARTUP_SCRIPT.replace('import app,', 'import pandas, app,')),
+                          ('without', STARTUP_SCRIPT)):
+        results = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True,
+                                    text=True, check=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        results.sort(key=lambda result: result['import'])
+        result = results[len(results) // 2]
+        print(f"{label:14} {result['import']:>12.2f} {result['rss'] or 0:>7.0f}  {'yes' if result['pandas'] else 'no'}")
+
+    import pandas as pd
+    model, vectorizer, layout = app.current_model()
+    extracted = []
+    analyze_patterns = app.analyze_patterns
+    app.analyze_patterns = lambda data: extracted.append(data) or analyze_patterns(data)
+
+    print()
+    print(f"{'page':45} {'patterns pd ms':>14} {'Counter ms':>10} {'predict pd ms':>13} {'array ms':>8}  identical")
+    try:
+        for name, html in pages:
+            url = f"https://{name.rsplit('_', 1)[0].replace('_', '.')}/"
+            extracted.clear()
+            app.analyze_website_structure(url, html)
+            start = time.perf_counter()
+            expected = reference_analyze_patterns(extracted[0])
+            pandas_time = time.perf_counter() - start
+            start = time.perf_counter()
+            patterns = analyze_patterns(extracted[0])
+            counter_time = time.perf_counter() - start
+
+            feature_rows, html_snippets = candidate_inputs(html)
+            domain_type = app.classify_domain_type(app.extract_domain(url))
+            start = time.perf_counter()
+            predictions = app.predict_product_containers(feature_rows, html_snippets, domain_type)
+            array_time = time.perf_counter() - start
+            # The old path: the same matrix, passed to the model as a DataFrame
+            matrix = np.zeros((len(feature_rows), len(layout['columns'])))
+            start = time.perf_counter()
+            matrix[:, layout['tag_positions']] = [[row[column] for column in layout['tag_sources']] for row in feature_rows]
+            if domain_type in layout['domain_positions']:
+                matrix[:, layout['domain_positions'][domain_type]] = 1
+            matrix[:, layout['html_positions']] = vectorizer.transform(html_snippets)[:, layout['html_sources']]
+            expected_predictions = model.predict(pd.DataFrame(matrix, columns=layout['columns'], copy=False))
+            frame_time = time.perf_counter() - start
+
+            identical = patterns == expected and list(predictions) == list(expected_predictions)
+            print(f"{name:45} {pandas_time * 1000:>14.2f} {counter_time * 1000:>10.2f} "
+                  f"{frame_time * 1000:>13.1f} {array_time * 1000:>8.1f}  {'yes' if identical else 'NO'}")
+    finally:
+        app.analyze_patterns = analyze_patterns
+
+def scale_page(html, factor):
+    """The page with its largest group of repeated siblings (the product grid) repeated factor times"""
+    if factor == 1:
+        return html
+    soup = app.parse_html(html)
+    tag_statistics = app.compute_tag_statistics(soup)
+    tags = app.select_candidates(soup, tag_statistics)
+    # The grid is the group of repeated siblings holding the most text
+    groups = [group for group in app.group_repeated_candidates(tags, min_size=3) if len(group) >= 3]
+    if not groups:
+        return html
+    group = max(groups, key=lambda group: sum(tag_statistics[id(tags[index])]['text_length'] for index in group))
+    members = [tags[index] for index in group]
+    last = members[-1]
+    for _ in range(factor - 1):
+        for member in members:
+            duplicate = copy.copy(member)
+            last.insert_after(duplicate)
+            last = duplicate
+    return str(soup)
+
+def timed_stage(samples, name, function):
+    """Run function as one metrics request, adding its total and sub-stage times (ms) to samples"""
+    app.metrics.start_request()
+    try:
+        result = function()
+    finally:
+        timing = app.metrics.finish_request()
+    samples.setdefault(name, []).append(timing['totalMs'])
+    for stage, ms in timing['stagesMs'].items():
+        if stage != name:
+            samples.setdefault(f"{name}/{stage}", []).append(ms)
+    return result
+
+def run_page_stages(samples, url, html):
+    """Parse a page and run every pipeline entry point on it once"""
+    soup = timed_stage(samples, 'parse', lambda: app.parse_html(html))
+    rules = timed_stage(samples, 'analyze_website_structure', lambda: app.analyze_website_structure(url, html, soup))
+    timed_stage(samples, 'scrape_with_rules', lambda: app.scrape_with_rules(url, html, rules, soup))
+    timed_stage(samples, 'scrape_website_traditional', lambda: app.scrape_website_traditional(url, html, soup))
+    timed_stage(samples, 'extract_products', lambda: app.extract_products(soup, url))
+
+def summarize(values):
+    values = np.asarray(values)
+    return {
+        'n': len(values),
+        'meanMs': round(float(values.mean()), 2),
+        'p50Ms': round(float(np.percentile(values, 50)), 2),
+        'p90Ms': round(float(np.percentile(values, 90)), 2),
+        'p99Ms': round(float(np.percentile(values, 99)), 2),
+        'maxMs': round(float(values.max()), 2)
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_pipeline(pages, scales=(1, 10), repeat=3, json_path=None):
+    """Latency percentiles per stage, pages/sec and peak memory over the pages at each scale
+
+    Every page is run repeat times; pages/sec counts parse, analysis and
+    scraping with the learned rules, as a request without cached rules
+    does. Peak memory is the largest traced allocation while processing
+    one page, measured in a separate run because tracing slows it down.
+    """
+    random.seed(0)
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'parser': app.HTML_PARSER,
+        'modelFormat': app.model_info['format'],
+        'repeat': repeat,
+        'pages': [name for name, _ in pages],
+        'scales': {}
+    }
+    for factor in scales:
+        samples = {}
+        page_samples = {}
+        peak_bytes = 0
+        pipeline_seconds = 0.0
+        size = 0
+        for name, html in pages:
+            url = f"https://{name.rsplit('_', 1)[0].replace('_', '.')}/"
+            html = scale_page(html, factor)
+            size += len(html)
+            page_samples[name] = {}
+            for _ in range(repeat):
+                run_samples = {}
+                run_page_stages(run_samples, url, html)
+                pipeline_seconds += sum(run_samples[stage][0] for stage in
+                                        ('parse', 'analyze_website_structure', 'scrape_with_rules')) / 1000
+                for stage, values in run_samples.items():
+                    samples.setdefault(stage, []).extend(values)
+                    page_samples[name].setdefault(stage, []).extend(values)
+
+            tracemalloc.start()
+            run_page_stages({}, url, html)
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        runs = len(pages) * repeat
+        report['scales'][str(factor)] = {
+            'htmlMb': round(size / 1e6, 2),
+            'pagesPerSec': round(runs / pipeline_seconds, 3) if pipeline_seconds else None,
+            'peakTracedMb': round(peak_bytes / 1e6, 1),
+            'stages': {stage: summarize(values) for stage, values in sorted(samples.items())},
+            'pageMedianMs': {name: {stage: round(float(np.median(values)), 2) for stage, values in sorted(stages.items())}
+                             for name, stages in page_samples.items()}
+        }
+
+        result = report['scales'][str(factor)]
+        print(f"scale {factor}x: {len(pages)} pages, {result['htmlMb']} MB of HTML, {result['pagesPerSec']} pages/s, "
+              f"peak traced memory {result['peakTracedMb']} MB")
+        print(f"  {'stage':48} {'n':>4} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for stage, summary in result['stages'].items():
+            print(f"  {stage:48} {summary['n']:>4} {summary['p50Ms']:>9.1f} {summary['p90Ms']:>9.1f} "
+                  f"{summary['p99Ms']:>9.1f} {summary['maxMs']:>9.1f}")
+        print()
+
+    # ru_maxrss is in KB on Linux
+    report['maxRssMb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    print(f"max RSS {report['maxRssMb']} MB")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {json_path}")
+
+def reference_extract_product(container, extraction_rules, product_id):
+    """extract_product_with_rules as it was, with one select() per selector, for comparison"""
+    product = {
+        "id": product_id,
+        "name": "Unknown Product",
+        "price": 0.0,
+        "category": "Unknown",
+        "rating": round(random.uniform(3.0, 5.0), 1),
+        "inStock": bool(random.getrandbits(1))
+    }
+
+    # Extract product name
+    name_found = False
+    for name_selector in extraction_rules['selectors']['name_elements']:
+        if isinstance(name_selector, dict):
+            continue
+        name_elements = container.select(name_selector)
+        if name_elements:
+            product['name'] = name_elements[0].get_text(strip=True)
+            name_found = True
+            break
+
+    # If no name found with selectors, try generic approach
+    if not name_found:
+        name_element = container.select_one('h1, h2, h3, h4, .title, .name')
+        if name_element:
+            product['name'] = name_element.get_text().strip()
+
+    # Extract price
+    price_found = False
+    for price_selector in extraction_rules['selectors']['price_elements']:
+        if isinstance(price_selector, dict):
+            continue
+        price_elements = container.select(price_selector)
+        if price_elements:
+            price_text = price_elements[0].get_text(strip=True)
+            price_match = re.search(r'(\d+\.\d+|\d+)', price_text)
+            if price_match:
+                product['price'] = float(price_match.group(1))
+                price_found = True
+                break
+
+    # If no price found with selectors, try generic approach
+    if not price_found:
+        price_pattern = r'(\$|€|£|USD)\s*(\d+(?:\.\d{2})?)'
+        price_texts = container.get_text()
+        price_match = re.search(price_pattern, price_texts)
+        if price_match:
+            try:
+                product['price'] = float(price_match.group(2))
+            except ValueError:
+                pass
+
+    # Try to extract category
+    category_text = container.get_text().lower()
+    categories = ["Electronics", "Clothing", "Home", "Books", "Beauty"]
+    for category in categories:
+        if category.lower() in category_text:
+            product["category"] = category
+            break
+
+    # Check for stock information
+    stock_element = container.select_one('.stock, .availability, [class*=stock], [class*=availability]')
+    if stock_element:
+        product["inStock"] = "in stock" in stock_element.get_text().lower()
+
+    return product
+
+def bench_rules(pages):
+    """Compare the compiled rule program with one select() per selector on every matched container
+
+    Each container is extracted with the same random seed both ways, so
+    whole products can be compared. 'kept' counts products left after
+    skipping nested containers that repeat an enclosing one, and
+    'distinct' the distinct (name, price) pairs before and after (the
+    non-zero prices among them in brackets); 'dead' counts the selectors
+    that pruning would drop.
+    """
+    print(f"{'page':45} {'containers':>10} {'select() s':>10} {'program s':>9} {'identical':>9} "
+          f"{'kept':>5} {'distinct':>17} {'dead':>9}")
+    for name, html in pages:
+        url = f"https://{name.rsplit('_', 1)[0].replace('_', '.')}/"
+        soup = app.parse_html(html)
+        rules = app.analyze_website_structure(url, html, soup)
+        containers = app.find_product_containers(soup, html, rules['selectors']['product_containers'])
+
+        expected = []
+        start = time.perf_counter()
+        for index, container in enumerate(containers):
+            random.seed(index)
+            expected.append(reference_extract_product(container, rules, index + 1))
+        select_time = time.perf_counter() - start
+
+        products = []
+        rule_hits = {'name_elements': Counter(), 'price_elements': Counter()}
+        start = time.perf_counter()
+        for index, container in enumerate(containers):
+            random.seed(index)
+            products.append(app.extract_product_with_rules(container, rules, index + 1, rule_hits))
+        program_time = time.perf_counter() - start
+
+        kept = list(app.iter_distinct_products(containers, rules))
+        distinct = {(product['name'], product['price']) for product in products}
+        kept_distinct = {(product['name'], product['price']) for product in kept}
+        priced = sum(1 for _, price in distinct if price)
+        kept_priced = sum(1 for _, price in kept_distinct if price)
+
+        statistics = app.rule_statistics(rules, rule_hits, len(containers), 0)
+        pruned = app.prune_dead_selectors(rules, statistics, min_containers=1) or rules
+        selectors = len(app.field_selectors(rules['selectors']['name_elements'])) + \
+            len(app.field_selectors(rules['selectors']['price_elements']))
+        remaining = len(app.field_selectors(pruned['selectors']['name_elements'])) + \
+            len(app.field_selectors(pruned['selectors']['price_elements']))
+        print(f"{name:45} {len(containers):>10} {select_time:>10.3f} {program_time:>9.3f} "
+              f"{'yes' if products == expected else 'NO':>9} {len(kept):>5} "
+              f"{f'{len(distinct)} ({priced})':>8}/{f'{len(kept_distinct)} ({kept_priced})':<8} "
+              f"{selectors - remaining:>4}/{selectors:<4}")
+
+def bench_prices(pages, products=2000, scrapes=1000, page_products=50):
+    """Fill a price history store with products x scrapes points and time appends and queries
+
+    Each scrape records every product of one domain an hour apart, as one
+    bulk append. Queries read one product's whole history, the same
+    downsampled to 30 points, and the daily history of page_products
+    products as the scrapers ask for it. The pages are not used.
+    """
+    directory = tempfile.mkdtemp()
+    store = PriceHistoryStore(os.path.join(directory, 'prices.sqlite3'))
+    rng = random.Random(42)
+    names = [f"Product {index} {rng.choice(['Shoes', 'Shirt', 'Phone', 'Lamp'])}" for index in range(products)]
+    base_prices = [round(rng.uniform(5, 500), 2) for _ in names]
+    first = int(time.time()) - scrapes * 3600
+
+    start = time.perf_counter()
+    for scrape in range(scrapes):
+        store.record('shop.example.com', [(name, round(price * rng.uniform(0.9, 1.1), 2))
+                                          for name, price in zip(names, base_prices)], first + scrape * 3600)
+    append_time = time.perf_counter() - start
+    store._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    stats = store.stats()
+    print(f"Appended {stats['points']} points for {stats['products']} products in {append_time:.1f}s "
+          f"({stats['points'] / append_time:,.0f} points/s, {append_time / scrapes * 1000:.2f} ms per scrape), "
+          f"{stats['bytes'] / stats['points']:.1f} bytes/point")
+
+    def timed(label, query, runs=50):
+        start = time.perf_counter()
+        for _ in range(runs):
+            result = query()
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"{label:45} {elapsed * 1000:>8.2f} ms  {result}")
+
+    last = first + scrapes * 3600
+    timed('one product, every point', lambda: len(store.history('shop.example.com', names[7])))
+    timed('one product, 30 points', lambda: len(store.history('shop.example.com', names[7], first, last, points=30)))
+    timed('one product, last 7 days hourly', lambda: len(store.history(
+        'shop.example.com', names[7], last - 7 * 86400, last, bucket_seconds=3600)))
+    timed(f"{page_products} products, daily over 30 days", lambda: sum(map(len, store.histories(
+        'shop.example.com', names[:page_products], last - 30 * 86400, last, bucket_seconds=86400).values())), runs=10)
+    page = [{'id': index, 'name': name, 'price': 1.0} for index, name in enumerate(names[:page_products])]
+    saved = app.price_history_store
+    app.price_history_store = store
+    try:
+        timed(f"{page_products} products, product_price_history", lambda: sum(
+            len(app.product_price_history('shop.example.com', product)['priceData']) for product in page), runs=10)
+        timed(f"{page_products} products, product_price_histories", lambda: sum(
+            len(history['priceData']) for history in app.product_price_histories('shop.example.com', page)), runs=10)
+    finally:
+        app.price_history_store = saved
+
+def bench_fingerprints(pages):
+    """Time both fingerprints of every page and show the skeleton distances between pages
+
+    Pages of one template should be within app.SIMHASH_THRESHOLD bits of
+    each other and pages of other templates or sites beyond it.
+    """
+    skeletons = []
+    print(f"{'page':45} {'features':>8} {'digest ms':>9} {'simhash ms':>10}  simhash")
+    for name, html in pages:
+        soup = app.parse_html(html)
+        start = time.perf_counter()
+        fingerprint.content_digest(html)
+        digest_time = time.perf_counter() - start
+        start = time.perf_counter()
+        skeleton = fingerprint.skeleton_simhash(soup)
+        simhash_time = time.perf_counter() - start
+        skeletons.append(skeleton)
+        print(f"{name:45} {len(fingerprint.skeleton_features(soup)):>8} {digest_time * 1000:>9.2f} "
+              f"{simhash_time * 1000:>10.2f}  {skeleton}")
+
+    print()
+    print(f"Skeleton distances in bits (threshold {app.SIMHASH_THRESHOLD})")
+    for (name, _), skeleton in zip(pages, skeletons):
+        print(f"{name:45} " + ' '.join(f"{fingerprint.hamming_distance(skeleton, other):>2}" for other in skeletons))
+
+def bench_download(pages, scales=(1, 10, 40), caps=(0, 8 * 1024 * 1024)):
+    """Peak RSS of downloading and scraping the largest page and scaled copies of it, per byte cap
+
+    Pages are served by the stand-in server and each run is a fresh
+    interpreter, so peak RSS is that of one request.
+    """
+    name, html = max(pages, key=lambda page: len(page[1]))
+    directory = tempfile.mkdtemp()
+    for factor in scales:
+        with open(os.path.join(directory, f"x{factor}.html"), 'w', encoding='utf-8') as f:
+            f.write(scale_page(html, factor))
+    server = stand_in_server.start_stand_in_server(directory=directory)
+
+    print(f"Scaling {name}")
+    print(f"{'scale':>5} {'page MB':>8} {'cap MiB':>7} {'kept MB':>8} {'seconds':>8} {'peak RSS MB':>11} "
+          f"{'products':>8} {'truncated':>9}")
+    try:
+        for factor in scales:
+            size = os.path.getsize(os.path.join(directory, f"x{factor}.html"))
+            for cap in caps:
+                env = dict(os.environ, WEBMINER_MAX_PAGE_BYTES=str(cap), WEBMINER_HTTP_CACHE_DIR='',
+                           WEBMINER_PRICE_HISTORY_DB='', WEBMINER_TRAINING_CORPUS=os.path.join(directory, 'corpus'),
+                           PYTHONWARNINGS='ignore')
+                url = f"http://127.0.0.1:{server.server_port}/x{factor}.html"
+                output = subprocess.run([sys.executable, '-c', DOWNLOAD_SCRIPT, url], env=env, capture_output=True,
+                                        text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{factor:>5} {size / 1e6:>8.1f} {cap // 2 ** 20 if cap else '-':>7} {result['bytes'] / 1e6:>8.1f} "
+                      f"{result['seconds']:>8.2f} {result['rss']:>11.0f} {result['products']:>8} "
+                      f"{'yes' if result['truncated'] else 'no':>9}")
+    finally:
+        server.shutdown()
+
+def bench_results(pages, concurrency=8):
+    """Scrapes run for concurrent requests on an empty cache, then the latency of fresh and stale hits
+
+    Pages are served by the stand-in server. For each page, concurrency
+    requests arrive at once; coalescing should leave one scrape among
+    them, and 'cold s' is the time until all were answered. The result is
+    then aged past the max age and concurrency requests arrive again: they
+    are answered stale and 'refreshes' should be 1. 'strict' repeats that
+    with a result younger than the server's max age but older than the
+    max_age the requests send (with max_stale); it should be 1 as well.
+    """
+    directory = tempfile.mkdtemp()
+    for name, html in pages:
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.write(html)
+    server = stand_in_server.start_stand_in_server(directory=directory)
+    client = app.app.test_client()
+
+    def post(url, **fields):
+        start = time.perf_counter()
+        response = client.post('/', json={'url': url, **fields})
+        return response.headers.get('X-WebMiner-Cache'), time.perf_counter() - start
+
+    print(f"{'page':45} {'requests':>8} {'scrapes':>7} {'cold s':>6} {'fresh ms':>8} {'stale ms':>8} {'refreshes':>9} "
+          f"{'strict':>6}")
+    try:
+        for name, _ in pages:
+            url = f"http://127.0.0.1:{server.server_port}/{name}"
+            scrapes = app.result_cache.stats()['scrapes']
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as requests:
+                statuses = list(requests.map(lambda _: post(url)[0], range(concurrency)))
+            wall = time.perf_counter() - start
+            coalesced_scrapes = app.result_cache.stats()['scrapes'] - scrapes
+
+            _, fresh = post(url)
+            app.result_cache.put(url, app.result_cache.entries[url]['data'],
+                                 stored_at=time.time() - app.RESULT_MAX_AGE - 1)
+            scrapes = app.result_cache.stats()['scrapes']
+            with ThreadPoolExecutor(max_workers=concurrency) as requests:
+                stale = max(requests.map(lambda _: post(url)[1], range(concurrency)))
+            while app.result_cache.stats()['refreshing']:
+                time.sleep(0.01)
+            refreshes = app.result_cache.stats()['scrapes'] - scrapes
+
+            max_age = app.RESULT_MAX_AGE // 10
+            app.result_cache.put(url, app.result_cache.entries[url]['data'], stored_at=time.time() - max_age * 5)
+            scrapes = app.result_cache.stats()['scrapes']
+            with ThreadPoolExecutor(max_workers=concurrency) as requests:
+                strict_statuses = list(requests.map(
+                    lambda _: post(url, max_age=max_age, max_stale=max_age * 10)[0], range(concurrency)))
+            while app.result_cache.stats()['refreshing']:
+                time.sleep(0.01)
+            strict = app.result_cache.stats()['scrapes'] - scrapes
+            if strict_statuses.count('stale') != concurrency or post(url, max_age=max_age)[0] != 'fresh':
+                strict = f"{strict} NO"
+            print(f"{name:45} {statuses.count('miss'):>8} {coalesced_scrapes:>7} {wall:>6.2f} "
+                  f"{fresh * 1000:>8.2f} {stale * 1000:>8.2f} {refreshes:>9} {strict:>6}")
+    finally:
+        app.refresh_pool.shutdown(wait=True)
+        server.shutdown()
+
+def bench_streaming(pages):
+    """Time to the first streamed product against the whole scrape of each page
+
+    'at first' counts the containers extracted when the first product
+    record comes out. Products are streamed PRICE_HISTORY_CHUNK at a time as
+    they are extracted, so on pages with more products than that it must
+    stay below the total.
+    """
+    extracted = [0]
+    extract_product_with_rules = app.extract_product_with_rules
+
+    def counting_extract(*args, **kwargs):
+        extracted[0] += 1
+        return extract_product_with_rules(*args, **kwargs)
+
+    app.extract_product_with_rules = counting_extract
+    print(f"{'page':45} {'first ms':>8} {'total ms':>8} {'at first':>8} {'extracted':>9} {'products':>8} {'streamed':>8}")
+    try:
+        for name, html in pages:
+            url = f"https://{name.rsplit('_', 1)[0].replace('_', '.')}/"
+            app.page_results.clear()
+            extracted[0] = 0
+            first, at_first, products = None, None, 0
+            start = time.perf_counter()
+            for kind, _ in app.iter_scrape_page(url, html):
+                if kind == 'product':
+                    if first is None:
+                        first, at_first = time.perf_counter() - start, extracted[0]
+                    products += 1
+            total = time.perf_counter() - start
+            if products <= app.PRICE_HISTORY_CHUNK or not extracted[0]:
+                streamed = '-'
+            else:
+                streamed = 'yes' if at_first < extracted[0] else 'NO'
+            print(f"{name:45} {(first or 0) * 1000:>8.1f} {total * 1000:>8.1f} {at_first or 0:>8} {extracted[0]:>9} "
+                  f"{products:>8} {streamed:>8}")
+    finally:
+        app.extract_product_with_rules = extract_product_with_rules
+
+BENCHMARKS = {
+    'candidates': bench_candidates,
+    'download': bench_download,
+    'ecommerce': bench_ecommerce,
+    'features': bench_features,
+    'fingerprints': bench_fingerprints,
+    'groups': bench_groups,
+    'metrics': bench_metrics,
+    'model': bench_model,
+    'parsers': bench_parsers,
+    'pipeline': bench_pipeline,
+    'prices': bench_prices,
+    'results': bench_results,
+    'rules': bench_rules,
+    'startup': bench_startup,
+    'streaming': bench_streaming,
+    'xpath': bench_xpath
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scraping pipeline on saved pages')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--pages', default='*.html', help='glob of pages in training_data/ to use')
+    parser.add_argument('--scales', default='1,10', help='pipeline: comma-separated product grid repetitions')
+    parser.add_argument('--repeat', type=int, default=3, help='pipeline: runs per page and scale')
+    parser.add_argument('--json', help='pipeline: write the results to this file')
+    args = parser.parse_args()
+
+    if args.benchmark == 'pipeline':
+        bench_pipeline(load_pages(args.pages), [int(factor) for factor in args.scales.split(',')], args.repeat, args.json)
+    else:
+        BENCHMARKS[args.benchmark](load_pages(args.pages))
@@ -0,0 +1,228 @@
+"""Content-addressed store for the pages saved as training data
+
+Each distinct page is stored once, compressed, under its SHA-1; every time
+a page is saved a capture row records its URL, domain and time. The index
+is a SQLite file next to the pages:
+
+    training_corpus/
+        corpus.sqlite3
+        pages/ab/ab12...ef.html.zst   (.html.gz when zstandard is not installed)
+
+Import a directory written by the old save_training_example (HTML files
+plus url_mapping.txt) with:
+
+    python backend/corpus.py import backend/training_data --corpus training_corpus
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from sqlite_store import ThreadConnections
+
+# zstandard compresses HTML better and faster than gzip, but is optional
+try:
+    import zstandard
+    DEFAULT_CODEC = 'zst'
+except ImportError:
+    zstandard = None
+    DEFAULT_CODEC = 'gz'
+
+def compress(data, codec):
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+def decompress(data, codec):
+    if codec == 'zst':
+        if zstandard is None:
+            raise RuntimeError('This page is zstd-compressed, install zstandard to read it')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+class TrainingCorpus:
+    """Deduplicated, compressed pages with an indexed table of captures"""
+
+    def __init__(self, directory, codec=DEFAULT_CODEC):
+        self.directory = directory
+        self.codec = codec
+        os.makedirs(os.path.join(directory, 'pages'), exist_ok=True)
+        self.connections = ThreadConnections(os.path.join(directory, 'corpus.sqlite3'), row_factory=sqlite3.Row)
+        conn = self._connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                digest TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                first_seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS captures (
+                id INTEGER PRIMARY KEY,
+                digest TEXT NOT NULL REFERENCES pages (digest),
+                url TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                captured_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS captures_domain ON captures (domain, captured_at);
+            CREATE INDEX IF NOT EXISTS captures_url ON captures (url, captured_at);
+            CREATE UNIQUE INDEX IF NOT EXISTS captures_unique ON captures (digest, url, captured_at);
+            CREATE INDEX IF NOT EXISTS captures_time ON captures (captured_at);
+        ''')
+
+    def add(self, url, html, domain, captured_at=None):
+        """Record a capture of a page, storing its content unless already present
+
+        Returns (digest, True if the content was new).
+        """
+        data = html.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        captured_at = time.time() if captured_at is None else captured_at
+        conn = self._connection()
+
+        is_new = conn.execute('SELECT 1 FROM pages WHERE digest = ?', (digest,)).fetchone() is None
+        if is_new:
+            # The file is in place before its row, so a listed page can always be read
+            stored = compress(data, self.codec)
+            path = self._path(digest, self.codec)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(stored)
+            os.replace(tmp_path, path)
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO pages (digest, codec, size, stored_size, first_seen) VALUES (?, ?, ?, ?, ?)',
+                (digest, self.codec, len(data), len(stored), captured_at))
+            # Another writer may have stored the same page in the meantime
+            is_new = cursor.rowcount == 1
+
+        # The same capture is only recorded once, so importing a directory twice changes nothing
+        conn.execute('INSERT OR IGNORE INTO captures (digest, url, domain, captured_at) VALUES (?, ?, ?, ?)',
+                     (digest, url, domain, captured_at))
+        return digest, is_new
+
+    def get(self, digest):
+        """HTML of a stored page, or None if unknown"""
+        row = self._connection().execute('SELECT codec FROM pages WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        with open(self._path(digest, row['codec']), 'rb') as f:
+            return decompress(f.read(), row['codec']).decode('utf-8')
+
+    def captures(self, domain=None, url=None, since=None, until=None, limit=None):
+        """Capture rows matching the filters, newest first"""
+        conditions, params = [], []
+        for clause, value in (('domain = ?', domain), ('url = ?', url),
+                              ('captured_at >= ?', since), ('captured_at < ?', until)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        query = 'SELECT digest, url, domain, captured_at FROM captures'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY captured_at DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [dict(row) for row in self._connection().execute(query, params)]
+
+    def pages(self, domain=None):
+        """Every distinct page with its latest capture, ordered by digest"""
+        query = '''
+            SELECT p.digest, p.size, c.url, c.domain, c.captured_at
+            FROM pages p JOIN captures c ON c.id = (
+                SELECT id FROM captures WHERE digest = p.digest ORDER BY captured_at DESC, id DESC LIMIT 1)
+        '''
+        params = ()
+        if domain is not None:
+            query += ' WHERE c.domain = ?'
+            params = (domain,)
+        query += ' ORDER BY p.digest'
+        return [dict(row) for row in self._connection().execute(query, params)]
+
+    def iter_pages(self, domain=None):
+        """Yield (page, html) for every distinct page, reading one page at a time"""
+        for page in self.pages(domain):
+            yield page, self.get(page['digest'])
+
+    def stats(self):
+        conn = self._connection()
+        pages, size, stored_size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM pages').fetchone()
+        captures = conn.execute('SELECT COUNT(*) FROM captures').fetchone()[0]
+        return {
+            'pages': pages,
+            'captures': captures,
+            'bytes': size,
+            'storedBytes': stored_size,
+            'compressionRatio': round(size / stored_size, 2) if stored_size else 0.0
+        }
+
+    def _path(self, digest, codec):
+        return os.path.join(self.directory, 'pages', digest[:2], f"{digest}.html.{codec}")
+
+    def _connection(self):
+        return self.connections.get()
+
+def read_url_mapping(directory):
+    """Map file names in an old training_data directory to (url, domain)
+
+    Lines are 'path|url|domain', but URLs may contain '|' themselves, so
+    only the outer fields are split off.
+    """
+    mapping = {}
+    try:
+        with open(os.path.join(directory, 'url_mapping.txt'), encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('|')
+                if len(fields) >= 3:
+                    mapping[os.path.basename(fields[0])] = ('|'.join(fields[1:-1]), fields[-1])
+    except OSError:
+        pass
+    return mapping
+
+def import_directory(corpus, directory):
+    """Add every page of an old training_data directory to the corpus, returning counts"""
+    mapping = read_url_mapping(directory)
+    counts = {'files': 0, 'newPages': 0}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.html'):
+            continue
+        stem, _, stamp = name[:-len('.html')].rpartition('_')
+        # Files are named <domain with dots as _>_<%Y%m%d%H%M%S>.html
+        try:
+            captured_at = datetime.strptime(stamp, '%Y%m%d%H%M%S').timestamp()
+        except ValueError:
+            captured_at = os.path.getmtime(os.path.join(directory, name))
+        domain = stem.replace('_', '.')
+        url, domain = mapping.get(name, (f"https://{domain}/", domain))
+
+        with open(os.path.join(directory, name), encoding='utf-8', errors='replace') as f:
+            _, is_new = corpus.add(url, f.read(), domain, captured_at)
+        counts['files'] += 1
+        counts['newPages'] += is_new
+    return counts
+
+if __name__ == '__main__':
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--corpus', default='training_corpus', help='corpus directory')
+    parser = argparse.ArgumentParser(description='Manage the training corpus')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', parents=[common], help='import an old training_data directory')
+    import_parser.add_argument('directory')
+    commands.add_parser('stats', parents=[common], help='show corpus size')
+    args = parser.parse_args()
+
+    corpus = TrainingCorpus(args.corpus)
+    if args.command == 'import':
+        start = time.perf_counter()
+        counts = import_directory(corpus, args.directory)
+        print(f"Imported {counts['files']} files ({counts['newPages']} new pages) "
+              f"in {time.perf_counter() - start:.2f}s")
+    stats = corpus.stats()
+    print(f"{stats['pages']} pages, {stats['captures']} captures, {stats['bytes'] / 1e6:.1f} MB stored as "
+          f"{stats['storedBytes'] / 1e6:.1f} MB ({stats['compressionRatio']}x, {corpus.codec})")
@@ -0,0 +1,226 @@
+"""Pooled HTTP page fetcher with an on-disk conditional-GET cache"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+
+# urllib3 only decodes brotli responses when one of these packages is installed
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = 'gzip, deflate, br'
+    except ImportError:
+        ACCEPT_ENCODING = 'gzip, deflate'
+
+# Bodies are read in chunks of this size so a page over the byte cap is never held whole
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+class PageFetcher:
+    """Fetch pages over a keep-alive session pool
+
+    Responses carrying an ETag or Last-Modified header are stored in
+    cache_dir and revalidated with a conditional GET, so an unchanged page
+    costs a 304 instead of a full download. At most per_host_limit requests
+    run against the same host at once.
+
+    Bodies are streamed and cut at max_page_bytes (after decompression, 0
+    for no limit): the rest of the page is never downloaded and the part
+    kept ends before the last tag that may have been split. Truncated pages
+    are not cached.
+    """
+
+    def __init__(self, cache_dir=None, per_host_limit=4, pool_size=10, user_agent=DEFAULT_USER_AGENT,
+                 max_page_bytes=0):
+        self.cache_dir = cache_dir
+        self.max_page_bytes = max_page_bytes
+        self.per_host_limit = per_host_limit
+        self.pool_size = pool_size
+        self.user_agent = user_agent
+        self.lock = threading.Lock()
+        self.host_slots = {}
+        self.session = None
+        self.session_pid = None
+        self.counters = {
+            'requests': 0,
+            'notModified': 0,
+            'cacheStores': 0,
+            'bytesDownloaded': 0,
+            'truncated': 0
+        }
+
+    def fetch(self, url, timeout=10):
+        """Download a page and return its decoded text"""
+        return self.fetch_page(url, timeout)[0]
+
+    def fetch_page(self, url, timeout=10):
+        """Download a page and return (decoded text, whether it was cut at max_page_bytes)"""
+        cached = self._load(url)
+        headers = {'User-Agent': self.user_agent, 'Accept-Encoding': ACCEPT_ENCODING}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response, body, truncated = self._get(url, headers, timeout)
+        if response.status_code == 304:
+            if cached is not None:
+                with self.lock:
+                    self.counters['notModified'] += 1
+                return cached['body'].decode(cached['encoding'] or 'utf-8', errors='replace'), False
+            # Not modified, but there is no copy to fall back on: ask for the page itself
+            headers = {'User-Agent': self.user_agent, 'Accept-Encoding': ACCEPT_ENCODING, 'Cache-Control': 'no-cache'}
+            response, body, truncated = self._get(url, headers, timeout)
+            if response.status_code == 304:
+                raise requests.exceptions.HTTPError(f"304 Not Modified without a cached copy for url: {url}",
+                                                    response=response)
+
+        response.raise_for_status()
+        if response.encoding is None:
+            # What response.apparent_encoding guesses, without keeping a second copy of the body
+            response.encoding = chardet.detect(body)['encoding'] if chardet is not None else 'utf-8'
+        if not truncated:
+            self._store(url, response, body)
+        # Decoded as response.text would
+        try:
+            return str(body, response.encoding, errors='replace'), truncated
+        except (LookupError, TypeError):
+            return str(body, errors='replace'), truncated
+
+    async def fetch_many(self, urls, timeout=10, concurrency=16):
+        """Fetch many pages concurrently from asyncio code
+
+        Returns a list aligned with urls holding the page text or the
+        exception raised for that URL.
+        """
+        slots = asyncio.Semaphore(concurrency)
+
+        async def fetch_one(url):
+            async with slots:
+                try:
+                    return await asyncio.to_thread(self.fetch, url, timeout)
+                except Exception as e:
+                    return e
+
+        return await asyncio.gather(*(fetch_one(url) for url in urls))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _get(self, url, headers, timeout):
+        """GET url, returning (response, body, truncated)"""
+        with self._host_slot(url):
+            response = self._session().get(url, headers=headers, timeout=timeout, stream=True)
+            try:
+                body, truncated = self._read_body(response)
+            finally:
+                response.close()
+
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['bytesDownloaded'] += len(body)
+            self.counters['truncated'] += truncated
+        return response, body, truncated
+
+    def _read_body(self, response):
+        """Body of a streamed response and whether it was cut at max_page_bytes"""
+        body = bytearray()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            body += chunk
+            if self.max_page_bytes and len(body) > self.max_page_bytes:
+                cut = body.rfind(b'<', 0, self.max_page_bytes)
+                del body[cut if cut > 0 else self.max_page_bytes:]
+                return body, True
+        return body, False
+
+    def _session(self):
+        # Sockets must not be shared with the parent after a fork
+        pid = os.getpid()
+        if self.session is None or self.session_pid != pid:
+            with self.lock:
+                if self.session is None or self.session_pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self.session = session
+                    self.session_pid = pid
+        return self.session
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self.host_slots[host]
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json'), os.path.join(self.cache_dir, key + '.body')
+
+    def _load(self, url):
+        if not self.cache_dir:
+            return None
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                meta['body'] = f.read()
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('url') == url else None
+
+    def _store(self, url, response, body):
+        """Cache a response for revalidation; a failure to write it only costs the next fetch a full download"""
+        if not self.cache_dir:
+            return
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'encoding': response.encoding,
+            'stored_at': time.time()
+        }
+        # Write body before metadata so a reader never sees metadata without a body
+        meta_path, body_path = self._paths(url)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(body_path + suffix, 'wb') as f:
+                f.write(body)
+            os.replace(body_path + suffix, body_path)
+            with open(meta_path + suffix, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + suffix, meta_path)
+        except OSError as e:
+            print(f"Caching {url} failed: {str(e)}")
+            for path in (body_path + suffix, meta_path + suffix):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return
+
+        with self.lock:
+            self.counters['cacheStores'] += 1
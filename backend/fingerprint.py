@@ -0,0 +1,101 @@
+"""Page fingerprints and a cache of scrape results keyed by page content
+
+A page has two fingerprints. The exact one is the SHA-1 of its HTML, so
+a page served again unchanged can be answered from the cache. The
+structural one is a 64-bit simhash of its DOM skeleton: the set of
+parent>tag.classes pairs, without text or attributes. Pages built from
+the same template differ in a few bits, so extraction rules learned on
+one can be reused on the other.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from bs4 import Tag
+
+SIMHASH_BITS = 64
+
+def content_digest(html):
+    """Exact fingerprint of a page"""
+    return hashlib.sha1(html.encode('utf-8', 'surrogatepass')).hexdigest()
+
+def skeleton_features(soup):
+    """Distinct parent>tag.classes pairs of the page
+
+    A set rather than counts, so the same template with more or fewer
+    products has the same skeleton.
+    """
+    features = set()
+    for tag in soup.descendants:
+        if isinstance(tag, Tag):
+            classes = tag.get('class')
+            parent = tag.parent.name if tag.parent is not None else ''
+            features.add(f"{parent}>{tag.name}.{'.'.join(sorted(classes)) if classes else ''}")
+    return features
+
+def skeleton_simhash(soup):
+    """Structural fingerprint of a page as a 16 digit hex string"""
+    features = skeleton_features(soup)
+    if not features:
+        return f"{0:016x}"
+    digests = b''.join(hashlib.blake2b(feature.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+                       for feature in features)
+    # One row of 64 bits per feature; a bit of the simhash is set where most features set it
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(len(features), SIMHASH_BITS)
+    majority = bits.sum(axis=0) * 2 > len(features)
+    return np.packbits(majority).tobytes().hex()
+
+def hamming_distance(a, b):
+    """Number of differing bits between two simhashes"""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+class PageResultCache:
+    """Scrape records of recently seen pages keyed by content, with LRU and TTL eviction"""
+
+    def __init__(self, max_entries=128, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached records for key, or None on a miss"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry['stored_at'] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry['records']
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, records):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = {'stored_at': time.time(), 'records': records}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'entries': len(self.entries),
+                'maxEntries': self.max_entries,
+                'ttl': self.ttl
+            }
@@ -0,0 +1,23 @@
+"""gunicorn settings for production, run from the repository root:
+
+    gunicorn -c backend/gunicorn.conf.py app:app
+
+The app (and with it the model) is imported once in the master and the
+workers are forked from it, so they share those pages copy-on-write
+instead of each loading its own copy. Set WEBMINER_PRELOAD=0 to load the
+app in every worker instead.
+"""
+import gc
+import os
+
+pythonpath = os.path.dirname(os.path.abspath(__file__))
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+timeout = 120
+preload_app = os.environ.get('WEBMINER_PRELOAD', '1') != '0'
+
+def when_ready(server):
+    # Runs in the master before any worker is forked. Frozen objects are
+    # skipped by the garbage collector, so collections in the workers do
+    # not write to (and thereby copy) the pages shared with the master.
+    gc.freeze()
@@ -0,0 +1,293 @@
+"""Background scrape jobs with a bounded queue and expiring results
+
+Jobs are kept either in process memory or in a SQLite file. The SQLite
+store lets several gunicorn workers share one queue without any external
+service: each worker process runs its own threads that claim queued jobs
+from the shared table.
+
+A process renews the lease of the jobs it runs (their updated_at) every
+quarter lease. A running job whose lease has run out belonged to a
+process that died, and is marked failed so pollers get an answer.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+from sqlite_store import ThreadConnections
+
+class MemoryJobStore:
+    """Jobs held in a dict, visible to the current process only"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queued = deque()
+
+    def submit(self, url, max_queued):
+        """Add a queued job, or return None if the queue is full"""
+        with self.lock:
+            if len(self.queued) >= max_queued:
+                return None
+            job = new_job(url)
+            self.jobs[job['id']] = job
+            self.queued.append(job['id'])
+            return dict(job)
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it"""
+        with self.lock:
+            while self.queued:
+                job = self.jobs.get(self.queued.popleft())
+                if job is not None and job['status'] == 'queued':
+                    job['status'] = 'running'
+                    job['updated_at'] = time.time()
+                    return dict(job)
+            return None
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+
+    def touch(self, job_ids):
+        """Renew the lease of running jobs"""
+        now = time.time()
+        with self.lock:
+            for job_id in job_ids:
+                if job_id in self.jobs:
+                    self.jobs[job_id]['updated_at'] = now
+
+    def expire(self, updated_before, error):
+        """Fail running jobs whose lease ran out"""
+        now = time.time()
+        with self.lock:
+            for job in self.jobs.values():
+                if job['status'] == 'running' and job['updated_at'] < updated_before:
+                    job.update(status='failed', stage='failed', error=error, finished_at=now, updated_at=now)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def purge(self, finished_before):
+        """Drop finished jobs older than the retention window"""
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job['finished_at'] is not None and job['finished_at'] < finished_before]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return counts
+
+class SQLiteJobStore:
+    """Jobs held in a SQLite table that several processes can share"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = ThreadConnections(path, row_factory=sqlite3.Row)
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finished_at REAL,
+                    result TEXT,
+                    error TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)')
+
+    def submit(self, url, max_queued):
+        job = new_job(url)
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= max_queued:
+                conn.execute('ROLLBACK')
+                return None
+            conn.execute(
+                'INSERT INTO jobs (id, url, status, stage, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job['id'], job['url'], job['status'], job['stage'], job['created_at'], job['updated_at']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return job
+
+    def claim(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                conn.execute('ROLLBACK')
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(row[0])
+
+    def update(self, job_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        self._connection().execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def touch(self, job_ids):
+        self._connection().execute(
+            f"UPDATE jobs SET updated_at = ? WHERE status = 'running' AND id IN ({','.join('?' * len(job_ids))})",
+            (time.time(), *job_ids))
+
+    def expire(self, updated_before, error):
+        now = time.time()
+        self._connection().execute(
+            "UPDATE jobs SET status = 'failed', stage = 'failed', error = ?, finished_at = ?, updated_at = ? "
+            "WHERE status = 'running' AND updated_at < ?", (error, now, now, updated_before))
+
+    def get(self, job_id):
+        conn = self._connection()
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def purge(self, finished_before):
+        self._connection().execute('DELETE FROM jobs WHERE finished_at < ?', (finished_before,))
+
+    def counts(self):
+        rows = self._connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def _connection(self):
+        return self.connections.get()
+
+def new_job(url):
+    now = time.time()
+    return {
+        'id': uuid.uuid4().hex,
+        'url': url,
+        'status': 'queued',
+        'stage': 'queued',
+        'created_at': now,
+        'updated_at': now,
+        'finished_at': None,
+        'result': None,
+        'error': None
+    }
+
+class JobQueue:
+    """Run jobs from a store on a pool of local worker threads
+
+    handler(url, report_stage) does the work and returns a JSON-serializable
+    result; report_stage(name) records progress for pollers. A running job
+    not renewed for lease seconds is failed.
+    """
+
+    def __init__(self, store, handler, workers=4, max_queued=100, result_ttl=3600, poll_interval=0.5, lease=60):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.heartbeat = None
+        # Ids of the jobs this process is running
+        self.running = set()
+
+    def submit(self, url):
+        """Queue a job and return it, or None when the queue is full"""
+        self._start_workers()
+        self._expire()
+        self.store.purge(time.time() - self.result_ttl)
+        job = self.store.submit(url, self.max_queued)
+        if job is not None:
+            self.wakeup.set()
+        return job
+
+    def get(self, job_id):
+        """Return a job, or None if it is unknown or its result has expired"""
+        self._expire()
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        if job['finished_at'] is not None and job['finished_at'] < time.time() - self.result_ttl:
+            return None
+        return job
+
+    def stats(self):
+        self._expire()
+        return {'workers': self.workers, 'maxQueued': self.max_queued, 'jobs': self.store.counts()}
+
+    def _start_workers(self):
+        # Threads are started on first use so they are created in the serving process, not before a fork
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            if self.heartbeat is None or not self.heartbeat.is_alive():
+                self.heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+                self.heartbeat.start()
+
+    def _expire(self):
+        self.store.expire(time.time() - self.lease, 'The worker running this job stopped')
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease / 4)
+            with self.lock:
+                job_ids = list(self.running)
+            if job_ids:
+                try:
+                    self.store.touch(job_ids)
+                except sqlite3.Error as e:
+                    print(f"Renewing job leases failed: {str(e)}")
+
+    def _work(self):
+        while True:
+            job = self.store.claim()
+            if job is None:
+                # Other processes may queue jobs in a shared store, so poll as well as wait
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            def report_stage(stage, job_id=job['id']):
+                self.store.update(job_id, stage=stage)
+
+            with self.lock:
+                self.running.add(job['id'])
+            try:
+                result = self.handler(job['url'], report_stage)
+                self.store.update(job['id'], status='done', stage='done', result=result, finished_at=time.time())
+            except Exception as e:
+                self.store.update(job['id'], status='failed', stage='failed', error=str(e), finished_at=time.time())
+            finally:
+                with self.lock:
+                    self.running.discard(job['id'])
@@ -0,0 +1,163 @@
+"""Per-request stage timings, counters and a sampling profiler
+
+Pipeline code wraps each stage in `with metrics.stage('parse'):` and
+counts work with metrics.inc(). Between start_request() and
+finish_request() the time of every stage is summed per request, so a
+stage that runs once per product is recorded once per request; the
+totals go into histograms and are returned for the response. Stages
+timed outside a request are recorded as they finish.
+
+Everything is kept per process: under gunicorn each worker reports its
+own numbers, and batch pages parsed in the process pool are not counted.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metrics:
+    """Stage histograms and counters rendered in the Prometheus text format"""
+
+    def __init__(self, prefix='webminer', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = Counter()
+        self.counter_help = {}
+        # stage -> [count per bucket, sum, count]
+        self.histograms = {}
+
+    def describe(self, name, help_text):
+        """Set the HELP text of a counter"""
+        self.counter_help[name] = help_text
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as part of stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            timings = getattr(self.local, 'timings', None)
+            if timings is None:
+                self.observe(name, elapsed)
+            else:
+                timings[name] = timings.get(name, 0.0) + elapsed
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def start_request(self):
+        """Start summing stage times for the request handled by this thread"""
+        self.local.timings = {}
+        self.local.started = time.perf_counter()
+
+    def finish_request(self):
+        """Record the stage totals of this thread's request and return them in milliseconds"""
+        timings = getattr(self.local, 'timings', None)
+        if timings is None:
+            return None
+        total = time.perf_counter() - self.local.started
+        self.local.timings = None
+        for name, seconds in timings.items():
+            self.observe(name, seconds)
+        self.observe('request', total)
+        return {
+            'stagesMs': {name: round(seconds * 1000, 2) for name, seconds in timings.items()},
+            'totalMs': round(total * 1000, 2)
+        }
+
+    def render(self, extra=()):
+        """Prometheus text exposition of all metrics
+
+        extra holds (name, type, help, value) tuples for values kept
+        elsewhere, such as cache statistics.
+        """
+        lines = []
+        with self.lock:
+            if self.histograms:
+                name = f"{self.prefix}_stage_seconds"
+                lines.append(f"# HELP {name} Time spent in each pipeline stage per request ('request' is the total)")
+                lines.append(f"# TYPE {name} histogram")
+                for stage, (bucket_counts, total, count) in sorted(self.histograms.items()):
+                    for bound, bucket_count in zip(self.buckets, bucket_counts):
+                        lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+            counters = [(f"{self.prefix}_{name}_total", 'counter', self.counter_help.get(name, name.replace('_', ' ')),
+                         value) for name, value in sorted(self.counters.items())]
+
+        for name, kind, help_text, value in counters + [(f"{self.prefix}_{name}", kind, help_text, value)
+                                                        for name, kind, help_text, value in extra]:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+class SamplingProfiler:
+    """Sample the stack of one thread at a fixed interval from a background thread
+
+    Stacks are collapsed to 'outer;...;inner' strings of
+    'function (file:line it is defined on)' entries, the format flame
+    graph tools read.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def stop(self, top=20):
+        """Stop sampling and return the most sampled stacks and functions"""
+        self.stopped.set()
+        self.thread.join()
+        functions = Counter()
+        for stack, count in self.samples.items():
+            for function in set(stack.split(';')):
+                functions[function] += count
+        return {
+            'intervalMs': self.interval * 1000,
+            'durationMs': round((time.perf_counter() - self.started) * 1000, 2),
+            'samples': sum(self.samples.values()),
+            'stacks': [{'stack': stack, 'samples': count} for stack, count in self.samples.most_common(top)],
+            'functions': [{'function': function, 'samples': count} for function, count in functions.most_common(top)]
+        }
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
@@ -0,0 +1,240 @@
+"""Loading the product container model, pickled or in a compact array format
+
+The pickled RandomForest and TF-IDF vectorizer need scikit-learn at load
+time, which dominates worker startup and memory. compact_artifacts()
+flattens the forest into plain node arrays and keeps only the vocabulary
+and idf weights of the vectorizer, saved together in one .npz file that
+loads with numpy alone and predicts the same classes:
+
+    python backend/model_store.py Model/product_container_model.pkl Model/html_vectorizer.pkl Model/product_container_model.npz
+"""
+import argparse
+import hashlib
+import os
+import re
+import time
+
+import numpy as np
+
+class CompactForest:
+    """RandomForestClassifier.predict over flattened tree arrays
+
+    Node arrays of all trees are concatenated, with each tree's root at
+    roots[i]. Leaves point to themselves, so walking every tree for depth
+    steps lands on the leaves whatever their depth.
+    """
+
+    def __init__(self, feature_names, classes, roots, left, right, feature, threshold, leaf_proba, depth):
+        self.feature_names_in_ = feature_names
+        self.classes_ = classes
+        self.roots = roots
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.leaf_proba = leaf_proba
+        self.depth = int(depth)
+
+    def predict_proba(self, X):
+        # Trees compare float32 features against float64 thresholds, like scikit-learn
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots)))
+        for _ in range(self.depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+
+        # Sum tree by tree in order (cumsum, unlike sum, is sequential) so ties break as in scikit-learn
+        proba = np.cumsum(self.leaf_proba[nodes], axis=1)[:, -1]
+        return proba / len(self.roots)
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+class CompactTfidf:
+    """TfidfVectorizer.transform for word unigrams, returning a dense array"""
+
+    def __init__(self, terms, idf, token_pattern, lowercase, norm):
+        self.terms = terms
+        self.vocabulary = {term: index for index, term in enumerate(terms)}
+        self.idf = idf
+        self.token_pattern = re.compile(token_pattern)
+        self.lowercase = bool(lowercase)
+        self.norm = norm
+
+    def get_feature_names_out(self):
+        return self.terms
+
+    def transform(self, documents):
+        rows, columns = [], []
+        vocabulary_get = self.vocabulary.get
+        findall = self.token_pattern.findall
+        for row, document in enumerate(documents):
+            if self.lowercase:
+                document = document.lower()
+            found = [column for column in map(vocabulary_get, findall(document)) if column is not None]
+            rows.extend([row] * len(found))
+            columns.extend(found)
+
+        width = len(self.terms)
+        flat = np.array(rows, dtype=np.intp) * width + np.array(columns, dtype=np.intp)
+        counts = np.bincount(flat, minlength=len(documents) * width).reshape(len(documents), width)
+
+        values = counts * self.idf
+        if self.norm == 'l2':
+            norms = np.sqrt(np.einsum('ij,ij->i', values, values))
+            norms[norms == 0.0] = 1.0
+            values /= norms[:, None]
+        elif self.norm == 'l1':
+            norms = np.abs(values).sum(axis=1)
+            norms[norms == 0.0] = 1.0
+            values /= norms[:, None]
+        return values
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def compact_artifacts(model, vectorizer, path, sources=()):
+    """Write a fitted forest and vectorizer to path as a compact .npz
+
+    sources are the pickle files they were loaded from; their hashes are
+    stored so a stale compact file is ignored after retraining.
+    """
+    params = vectorizer.get_params()
+    if (params['analyzer'] != 'word' or tuple(params['ngram_range']) != (1, 1) or params['tokenizer'] is not None
+            or params['preprocessor'] is not None or params['strip_accents'] is not None
+            or params['stop_words'] is not None or params['binary'] or params['sublinear_tf']
+            or not params['use_idf']):
+        raise ValueError('Only plain word-unigram TF-IDF vectorizers can be compacted')
+    if model.n_outputs_ != 1:
+        raise ValueError('Only single-output forests can be compacted')
+
+    roots, left, right, feature, threshold, leaf_proba = [], [], [], [], [], []
+    depth = 0
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        roots.append(offset)
+        left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+        right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+
+        # Normalized leaf values, as DecisionTreeClassifier.predict_proba computes them
+        value = tree.value[:, 0, :model.n_classes_].astype(np.float64)
+        normalizer = value.sum(axis=1)[:, None]
+        normalizer[normalizer == 0.0] = 1.0
+        leaf_proba.append(value / normalizer)
+
+        depth = max(depth, tree.max_depth)
+        offset += tree.node_count
+
+    terms = np.array(sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get))
+    np.savez(
+        path,
+        feature_names=np.asarray(model.feature_names_in_, dtype=str),
+        classes=model.classes_,
+        roots=np.array(roots, dtype=np.intp),
+        left=np.concatenate(left).astype(np.intp),
+        right=np.concatenate(right).astype(np.intp),
+        feature=np.concatenate(feature).astype(np.intp),
+        threshold=np.concatenate(threshold),
+        leaf_proba=np.concatenate(leaf_proba),
+        depth=np.array(depth),
+        terms=terms,
+        idf=vectorizer.idf_,
+        token_pattern=np.array(params['token_pattern']),
+        lowercase=np.array(params['lowercase']),
+        norm=np.array(params['norm'] or ''),
+        sources=np.array([file_digest(source) for source in sources], dtype=str)
+    )
+
+def source_matches(path, sources):
+    """Whether each of sources still has the digest recorded in the compact file at path
+
+    Empty when the file records no sources or the pickles are not deployed
+    alongside it.
+    """
+    if not all(os.path.exists(source) for source in sources):
+        return []
+    with np.load(path, allow_pickle=False) as data:
+        recorded = list(data['sources'])
+    return [digest == file_digest(source) for digest, source in zip(recorded, sources)]
+
+def load_compact(path, sources=()):
+    """Load a compact .npz, or return None if it was built from other pickles
+
+    The check is skipped when the pickles are not deployed alongside it.
+    """
+    if not all(source_matches(path, sources)):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        arrays = dict(data)
+
+    model = CompactForest(
+        [str(name) for name in arrays['feature_names']], arrays['classes'], arrays['roots'], arrays['left'], arrays['right'],
+        arrays['feature'], arrays['threshold'], arrays['leaf_proba'], arrays['depth'])
+    vectorizer = CompactTfidf(
+        [str(term) for term in arrays['terms']], arrays['idf'], str(arrays['token_pattern']), arrays['lowercase'],
+        str(arrays['norm']) or None)
+    return model, vectorizer
+
+def load_model_artifacts(model_path, vectorizer_path, compact_path=None, model_format='auto'):
+    """Load the model and vectorizer, returning (model, vectorizer, format)
+
+    model_format 'compact' or 'pickle' forces one format; 'auto' uses the
+    compact file when it matches the pickles and falls back to them
+    otherwise. Raises FileNotFoundError when no model is available and
+    ValueError when only one of the pickles differs from the ones the
+    compact file was built from: a model and a vectorizer from different
+    trainings, e.g. while retrain.py is replacing them.
+    """
+    if model_format not in ('auto', 'compact', 'pickle'):
+        raise ValueError(f"Unsupported model format '{model_format}', expected 'auto', 'compact' or 'pickle'")
+
+    if compact_path and os.path.exists(compact_path):
+        matches = source_matches(compact_path, (model_path, vectorizer_path))
+        if any(matches) and not all(matches):
+            raise ValueError(f"{model_path} and {vectorizer_path} are from different models")
+        if model_format != 'pickle':
+            if all(matches):
+                return (*load_compact(compact_path), 'compact')
+            if model_format == 'compact':
+                raise ValueError(f"{compact_path} was built from a different model, rebuild it")
+            print(f"{compact_path} was built from a different model, loading the pickles instead")
+    elif model_format == 'compact':
+        raise FileNotFoundError(compact_path)
+
+    # scikit-learn is only imported when the pickles are actually needed
+    import joblib
+    model = joblib.load(model_path)
+    vectorizer = joblib.load(vectorizer_path)
+    return model, vectorizer, 'pickle'
+
+def process_rss_mb():
+    """Resident memory of this process in MB (Linux only, None elsewhere)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the pickled model and vectorizer to the compact format')
+    parser.add_argument('model', help='pickled RandomForestClassifier')
+    parser.add_argument('vectorizer', help='pickled TfidfVectorizer')
+    parser.add_argument('output', help='compact .npz file to write')
+    args = parser.parse_args()
+
+    import joblib
+    start = time.perf_counter()
+    compact_artifacts(joblib.load(args.model), joblib.load(args.vectorizer), args.output,
+                      sources=(args.model, args.vectorizer))
+    print(f"Wrote {args.output} ({os.path.getsize(args.output) / 1024:.0f} KB) "
+          f"in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,171 @@
+"""SQLite time series of the product prices seen while scraping
+
+Every scrape appends one point per product in a single transaction.
+Products are identified by their domain and normalized name. Points are
+clustered by product and time (a WITHOUT ROWID table keyed on both), so
+a range query reads one contiguous run of the table. Downsampling
+happens in SQL, bucketing the range and returning the average, min and
+max price of each bucket.
+
+    python backend/price_history.py price_history.sqlite3 www.example.com "Product name" --points 30
+"""
+import argparse
+import json
+import os
+import time
+
+from sqlite_store import ThreadConnections
+
+# SQLite's default limit on bound parameters is 999 in older versions
+MAX_QUERY_PARAMETERS = 900
+
+def product_key(name):
+    """Stable identity of a product within its domain: its name, lowercased with whitespace collapsed"""
+    return ' '.join(name.lower().split())
+
+class PriceHistoryStore:
+    """Append-only price points per (domain, product) with downsampled range queries"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = ThreadConnections(path)
+        conn = self._connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY,
+                domain TEXT NOT NULL,
+                product_key TEXT NOT NULL,
+                name TEXT NOT NULL,
+                UNIQUE (domain, product_key)
+            );
+            CREATE TABLE IF NOT EXISTS prices (
+                product_id INTEGER NOT NULL REFERENCES products (id),
+                observed_at INTEGER NOT NULL,
+                price REAL NOT NULL,
+                PRIMARY KEY (product_id, observed_at)
+            ) WITHOUT ROWID;
+        ''')
+
+    def record(self, domain, observations, observed_at=None):
+        """Append (name, price) observations of one scrape, returning the number of points stored
+
+        Points share one timestamp (whole seconds); a product seen twice in
+        the same second keeps its last price.
+        """
+        observed_at = int(time.time() if observed_at is None else observed_at)
+        latest = {}
+        names = {}
+        for name, price in observations:
+            key = product_key(name)
+            if key:
+                latest[key] = price
+                names.setdefault(key, name)
+        if not latest:
+            return 0
+
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO products (domain, product_key, name) VALUES (?, ?, ?)',
+                             [(domain, key, names[key]) for key in latest])
+            ids = self._product_ids(conn, domain, list(latest))
+            conn.executemany('INSERT OR REPLACE INTO prices (product_id, observed_at, price) VALUES (?, ?, ?)',
+                             sorted((ids[key], observed_at, price) for key, price in latest.items()))
+        return len(latest)
+
+    def history(self, domain, name, since=None, until=None, points=None, bucket_seconds=None):
+        """Price points of one product, see histories()"""
+        return self.histories(domain, [name], since, until, points, bucket_seconds).get(product_key(name), [])
+
+    def histories(self, domain, names, since=None, until=None, points=None, bucket_seconds=None):
+        """Price points of several products in [since, until), keyed by product_key(name)
+
+        Without points or bucket_seconds every stored point is returned.
+        Otherwise the range is cut into buckets of bucket_seconds (or
+        into points equal buckets) starting at since, and each bucket with
+        data becomes one point holding the first timestamp, the average,
+        min and max price and the number of observations in it.
+        """
+        conn = self._connection()
+        ids = self._product_ids(conn, domain, list({product_key(name) for name in names}))
+        if not ids:
+            return {}
+        keys = {product_id: key for key, product_id in ids.items()}
+
+        if (points or bucket_seconds) and (since is None or until is None):
+            first, last = self._bounds(conn, list(keys))
+            since = first if since is None else since
+            until = last + 1 if until is None else until
+        since = 0 if since is None else int(since)
+        until = 2 ** 62 if until is None else int(until)
+
+        result = {key: [] for key in ids}
+        product_ids = list(keys)
+        for start in range(0, len(product_ids), MAX_QUERY_PARAMETERS):
+            chunk = product_ids[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ','.join('?' * len(chunk))
+            if points or bucket_seconds:
+                width = int(bucket_seconds or max(1, -(-(until - since) // points)))
+                rows = conn.execute(f'''
+                    SELECT product_id, MIN(observed_at), AVG(price), MIN(price), MAX(price), COUNT(*)
+                    FROM prices
+                    WHERE product_id IN ({placeholders}) AND observed_at >= ? AND observed_at < ?
+                    GROUP BY product_id, (observed_at - ?) / ?
+                    ORDER BY product_id, MIN(observed_at)
+                ''', (*chunk, since, until, since, width))
+                for product_id, observed_at, average, low, high, count in rows:
+                    result[keys[product_id]].append({
+                        'timestamp': observed_at, 'price': round(average, 2), 'min': low, 'max': high, 'count': count
+                    })
+            else:
+                rows = conn.execute(f'''
+                    SELECT product_id, observed_at, price FROM prices
+                    WHERE product_id IN ({placeholders}) AND observed_at >= ? AND observed_at < ?
+                    ORDER BY product_id, observed_at
+                ''', (*chunk, since, until))
+                for product_id, observed_at, price in rows:
+                    result[keys[product_id]].append({'timestamp': observed_at, 'price': price})
+        return result
+
+    def stats(self):
+        conn = self._connection()
+        products = conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+        points = conn.execute('SELECT COUNT(*) FROM prices').fetchone()[0]
+        return {'products': products, 'points': points,
+                'bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0}
+
+    def _product_ids(self, conn, domain, keys):
+        ids = {}
+        for start in range(0, len(keys), MAX_QUERY_PARAMETERS):
+            chunk = keys[start:start + MAX_QUERY_PARAMETERS]
+            rows = conn.execute(
+                f"SELECT product_key, id FROM products WHERE domain = ? AND product_key IN ({','.join('?' * len(chunk))})",
+                (domain, *chunk))
+            ids.update(rows)
+        return ids
+
+    def _bounds(self, conn, product_ids):
+        first, last = None, None
+        for product_id in product_ids:
+            low, high = conn.execute('SELECT MIN(observed_at), MAX(observed_at) FROM prices WHERE product_id = ?',
+                                     (product_id,)).fetchone()
+            if low is not None:
+                first = low if first is None else min(first, low)
+                last = high if last is None else max(last, high)
+        return (first or 0), (last or 0)
+
+    def _connection(self):
+        return self.connections.get()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the stored price history of a product')
+    parser.add_argument('database')
+    parser.add_argument('domain')
+    parser.add_argument('name')
+    parser.add_argument('--since', type=float, help='unix time')
+    parser.add_argument('--until', type=float, help='unix time')
+    parser.add_argument('--points', type=int, help='downsample to at most this many points')
+    args = parser.parse_args()
+
+    store = PriceHistoryStore(args.database)
+    print(json.dumps(store.history(args.domain, args.name, args.since, args.until, args.points), indent=2))
@@ -0,0 +1,217 @@
+"""URL-keyed cache of scrape results with stale-while-revalidate
+
+Results are kept in an in-memory LRU and, if a database path is given,
+in a SQLite table every gunicorn worker reads and writes. A lookup tells
+whether the cached result is fresh (younger than the max age asked for),
+stale (older, but within the stale window asked for, so it is served
+while it is refreshed) or missing.
+
+Scrapes of one URL are coalesced: within a process later callers wait
+for the scrape already running, and with the SQLite tier a worker that
+finds another worker's lease on the URL waits for its result instead of
+scraping the page as well.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from sqlite_store import ThreadConnections
+
+# Seconds a worker may hold the scrape of a URL before others stop waiting for it
+REFRESH_LEASE = 60
+# How often a waiting worker checks the database for the result
+POLL_INTERVAL = 0.25
+
+class ResultCache:
+    """scraped_data per URL in an LRU, optionally backed by SQLite"""
+
+    def __init__(self, max_entries=256, stale_ttl=3600, retention=None, db_path=None, cacheable=None):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        # Results older than this are deleted from the database
+        self.retention = stale_ttl if retention is None else retention
+        self.db_path = db_path
+        # Tells whether a scraped result may be stored; all are by default
+        self.cacheable = cacheable
+        self.entries = OrderedDict()
+        self.inflight = {}
+        # URLs with a background refresh queued or running
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.connections = ThreadConnections(db_path) if db_path else None
+        self.counters = {'hits': 0, 'staleHits': 0, 'misses': 0, 'coalesced': 0, 'scrapes': 0}
+
+        if self.db_path:
+            conn = self._connection()
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS results (
+                    url TEXT PRIMARY KEY,
+                    stored_at REAL NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS results_stored_at ON results (stored_at);
+                CREATE TABLE IF NOT EXISTS leases (
+                    url TEXT PRIMARY KEY,
+                    until REAL NOT NULL
+                );
+            ''')
+
+    def lookup(self, url, max_age, max_stale=None):
+        """Return (data, 'fresh' or 'stale') for a usable cached result, or (None, None)
+
+        A result older than max_age is stale for max_stale more seconds
+        (stale_ttl by default, never more).
+        """
+        max_stale = self.stale_ttl if max_stale is None else min(max_stale, self.stale_ttl)
+        entry = self._get(url)
+        age = time.time() - entry['stored_at'] if entry is not None else None
+        with self.lock:
+            if age is not None and age <= max_age:
+                self.counters['hits'] += 1
+                return entry['data'], 'fresh'
+            if age is not None and age <= max_age + max_stale:
+                self.counters['staleHits'] += 1
+                return entry['data'], 'stale'
+            self.counters['misses'] += 1
+            return None, None
+
+    def load(self, url, scrape, max_age=None):
+        """Scrape url with scrape() and cache the result, or wait for the scrape of it already running
+
+        With max_age, a cached result at most that old (e.g. stored by
+        another worker meanwhile) is returned instead of scraping again.
+        """
+        with self.lock:
+            future = self.inflight.get(url)
+            owner = future is None
+            if owner:
+                future = self.inflight[url] = Future()
+            else:
+                self.counters['coalesced'] += 1
+        if not owner:
+            return future.result()
+
+        leased = False
+        try:
+            data = None
+            if self.db_path:
+                leased = self._claim(url)
+                if not leased:
+                    with self.lock:
+                        self.counters['coalesced'] += 1
+                    data = self._wait_for_worker(url)
+            if data is None and max_age is not None:
+                entry = self._get(url)
+                if entry is not None and time.time() - entry['stored_at'] <= max_age:
+                    data = entry['data']
+            if data is None:
+                with self.lock:
+                    self.counters['scrapes'] += 1
+                data = scrape()
+                if self.cacheable is None or self.cacheable(data):
+                    self.put(url, data)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(url, None)
+            if leased:
+                self._connection().execute('DELETE FROM leases WHERE url = ?', (url,))
+
+    def start_refresh(self, url):
+        """Mark url as being refreshed, returning False if a refresh of it is already pending"""
+        with self.lock:
+            if url in self.refreshing:
+                return False
+            self.refreshing.add(url)
+            return True
+
+    def finish_refresh(self, url):
+        with self.lock:
+            self.refreshing.discard(url)
+
+    def put(self, url, data, stored_at=None):
+        entry = {'stored_at': time.time() if stored_at is None else stored_at, 'data': data}
+        self._remember(url, entry)
+        if self.db_path:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO results (url, stored_at, data) VALUES (?, ?, ?)',
+                         (url, entry['stored_at'], json.dumps(data)))
+            conn.execute('DELETE FROM results WHERE stored_at < ?', (time.time() - self.retention,))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['staleHits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'hitRate': round((self.counters['hits'] + self.counters['staleHits']) / lookups, 3) if lookups else 0.0,
+                'entries': len(self.entries),
+                'inflight': len(self.inflight),
+                'refreshing': len(self.refreshing),
+                'maxEntries': self.max_entries,
+                'shared': bool(self.db_path)
+            }
+
+    def _get(self, url):
+        """Newest entry for url from memory or, if newer there, the database"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        if self.db_path:
+            # Another worker may have stored a newer result
+            row = self._connection().execute(
+                'SELECT stored_at, data FROM results WHERE url = ? AND stored_at > ?',
+                (url, entry['stored_at'] if entry is not None else 0)).fetchone()
+            if row is not None:
+                entry = {'stored_at': row[0], 'data': json.loads(row[1])}
+                self._remember(url, entry)
+        return entry
+
+    def _remember(self, url, entry):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _claim(self, url):
+        """Take the lease on scraping url unless another worker holds it"""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT until FROM leases WHERE url = ?', (url,)).fetchone()
+            if row is not None and row[0] > now:
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases (url, until) VALUES (?, ?)', (url, now + REFRESH_LEASE))
+        return True
+
+    def _wait_for_worker(self, url):
+        """The result another worker is scraping, or None if it gives up or takes longer than its lease"""
+        started = time.time()
+        conn = self._connection()
+        while time.time() - started < REFRESH_LEASE:
+            time.sleep(POLL_INTERVAL)
+            # The lease is checked first: the result is stored before the lease is released
+            leased = conn.execute('SELECT 1 FROM leases WHERE url = ? AND until > ?',
+                                  (url, time.time())).fetchone() is not None
+            row = conn.execute('SELECT stored_at, data FROM results WHERE url = ? AND stored_at >= ?',
+                               (url, started)).fetchone()
+            if row is not None:
+                data = json.loads(row[1])
+                self._remember(url, {'stored_at': row[0], 'data': data})
+                return data
+            if not leased:
+                return None
+        return None
+
+    def _connection(self):
+        return self.connections.get()
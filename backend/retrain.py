@@ -0,0 +1,236 @@
+"""Retrain the product container model from the pages in the training corpus
+
+Candidate features of every page are cached on disk keyed by the hash of
+the page, so a run only parses pages added since the last one. Pages are
+labelled with the heuristic of Model/randomForest.ipynb (a price plus a
+buy / add-to-cart text or a product/item class), a share of them is held
+out to validate the new model against the current one, and the new model
+only replaces the current files if it scores at least as well. Running
+servers pick the new files up without a restart. Run from the repository
+root:
+
+    python backend/retrain.py --corpus training_corpus --jobs 4
+
+Exit codes: 0 new model promoted, 2 new model rejected by validation,
+1 error.
+"""
+import argparse
+import math
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics import precision_recall_fscore_support
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app  # noqa: E402
+from model_store import compact_artifacts  # noqa: E402
+from corpus import TrainingCorpus  # noqa: E402
+
+# Bump when the features or labels change so cached pages are featurized again
+FEATURE_VERSION = 2
+
+EXIT_PROMOTED = 0
+EXIT_ERROR = 1
+EXIT_REJECTED = 2
+
+def label_candidate(tag, features):
+    """1 if the tag looks like a product container, as labelled in the training notebook"""
+    if not features['has_price']:
+        return 0
+    text = tag.get_text().lower()
+    first_class = tag.get('class', [''])[0] if tag.get('class') else ''
+    return 1 if 'buy' in text or 'add to cart' in text or re.search(r'product|item', first_class) else 0
+
+def featurize_page(html):
+    """Structural features, HTML snippets and labels of the candidates on one page"""
+    soup = app.parse_html(html)
+    tags, feature_rows, html_snippets = app.extract_candidates(soup)
+    return {
+        'features': np.array([[row[column] for column in app.TAG_FEATURE_COLUMNS] for row in feature_rows],
+                             dtype=np.float64).reshape(len(feature_rows), len(app.TAG_FEATURE_COLUMNS)),
+        'snippets': np.array(html_snippets, dtype=str),
+        'labels': np.array([label_candidate(tag, row) for tag, row in zip(tags, feature_rows)], dtype=np.int64)
+    }
+
+def cache_path(cache_dir, page):
+    return os.path.join(cache_dir, f"{page['digest']}-v{FEATURE_VERSION}.npz")
+
+def load_cached(cache_dir, page):
+    try:
+        with np.load(cache_path(cache_dir, page), allow_pickle=False) as data:
+            return dict(data)
+    except (OSError, ValueError):
+        return None
+
+def store_cached(cache_dir, page, table):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, page)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **table)
+    os.replace(tmp_path, path)
+
+def collect_features(corpus, pages, cache_dir, jobs):
+    """Feature tables for all pages keyed by digest, featurizing only uncached pages
+
+    Uncached pages are read from the corpus a batch at a time, so memory
+    stays bounded however many are new. Returns (tables, number of pages
+    featurized in this run).
+    """
+    tables = {}
+    missing = []
+    for page in pages:
+        table = load_cached(cache_dir, page)
+        if table is None:
+            missing.append(page)
+        else:
+            tables[page['digest']] = table
+
+    workers = (os.cpu_count() or 1) if jobs == -1 else jobs
+    pool = ProcessPoolExecutor(max_workers=workers) if len(missing) > 1 and workers > 1 else None
+    try:
+        for start in range(0, len(missing), workers * 2):
+            batch = missing[start:start + workers * 2]
+            htmls = [corpus.get(page['digest']) for page in batch]
+            featurized = pool.map(featurize_page, htmls) if pool else map(featurize_page, htmls)
+            for page, table in zip(batch, featurized):
+                store_cached(cache_dir, page, table)
+                tables[page['digest']] = table
+    finally:
+        if pool:
+            pool.shutdown()
+    return tables, len(missing)
+
+def split_pages(pages, holdout):
+    """Split pages into training and held-out sets
+
+    Whole pages are held out, since containers of one page are near
+    duplicates. The split is ordered by content hash, so adding pages
+    never moves an existing page between the sets.
+    """
+    ordered = sorted(pages, key=lambda page: page['digest'])
+    count = min(math.ceil(len(ordered) * holdout), len(ordered) - 1) if holdout > 0 else 0
+    return ordered[count:], ordered[:count]
+
+def training_frame(pages, tables, vectorizer):
+    """Model input in the column layout the app builds in predict_product_containers"""
+    html_width = len(vectorizer.get_feature_names_out())
+    columns = (app.TAG_FEATURE_COLUMNS + [f"domain_{dt}" for dt in app.DOMAIN_TYPES] +
+               [f"html_feat_{i}" for i in range(html_width)])
+    blocks = []
+    for page in pages:
+        table = tables[page['digest']]
+        rows = len(table['labels'])
+        domain = np.zeros((rows, len(app.DOMAIN_TYPES)))
+        domain[:, app.DOMAIN_TYPES.index(app.classify_domain_type(page['domain']))] = 1
+        html = vectorizer.transform(list(table['snippets'])).toarray() if rows else np.zeros((0, html_width))
+        blocks.append(np.hstack([table['features'], domain, html]))
+    return pd.DataFrame(np.vstack(blocks), columns=columns)
+
+def evaluate(artifacts, pages, tables):
+    """Precision, recall and F1 of the product class on the given pages, predicted as the app does"""
+    expected = []
+    predicted = []
+    for page in pages:
+        table = tables[page['digest']]
+        if not len(table['labels']):
+            continue
+        feature_rows = [dict(zip(app.TAG_FEATURE_COLUMNS, row)) for row in table['features']]
+        domain_type = app.classify_domain_type(page['domain'])
+        predicted.extend(app.predict_product_containers(feature_rows, list(table['snippets']), domain_type, artifacts))
+        expected.extend(table['labels'])
+
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        expected, predicted, average='binary', pos_label=1, zero_division=0)
+    return {'precision': round(float(precision), 3), 'recall': round(float(recall), 3), 'f1': round(float(f1), 3)}
+
+def save_model(model, vectorizer):
+    """Replace the model files; each is written to a temporary file and renamed into place"""
+    for obj, path in ((model, app.MODEL_PATH), (vectorizer, app.VECTORIZER_PATH)):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(obj, tmp_path)
+        os.replace(tmp_path, path)
+
+    # The compact copy records the pickles it was built from: a reader that sees only
+    # one new pickle refuses to load, one that sees both loads them until it is replaced
+    tmp_path = f"{app.COMPACT_MODEL_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        compact_artifacts(model, vectorizer, f, sources=(app.MODEL_PATH, app.VECTORIZER_PATH))
+    os.replace(tmp_path, app.COMPACT_MODEL_PATH)
+
+def retrain(corpus_dir, cache_dir, jobs=-1, holdout=0.2, tolerance=0.0, force=False):
+    """Train a new model on the saved pages and promote it if it validates; returns an exit code"""
+    started = time.perf_counter()
+    corpus = TrainingCorpus(corpus_dir)
+    pages = corpus.pages()
+    if len(pages) < 2:
+        print(f"Need at least 2 pages in {corpus_dir} to train and validate, found {len(pages)}")
+        return EXIT_ERROR
+
+    tables, featurized = collect_features(corpus, pages, cache_dir, jobs)
+    print(f"Features for {len(pages)} pages ({featurized} featurized, {len(pages) - featurized} cached) "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    train_pages, holdout_pages = split_pages(pages, holdout)
+    labels = np.concatenate([tables[page['digest']]['labels'] for page in train_pages])
+    if len(set(labels.tolist())) < 2:
+        print("Training pages need both product and non-product candidates")
+        return EXIT_ERROR
+
+    # Same model and vectorizer settings as the training notebook
+    vectorizer = TfidfVectorizer(max_features=100)
+    vectorizer.fit(np.concatenate([tables[page['digest']]['snippets'] for page in train_pages]))
+    model = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=jobs)
+    model.fit(training_frame(train_pages, tables, vectorizer), labels)
+    # Predict sequentially when serving, as the compact format does
+    model.n_jobs = None
+    print(f"Trained on {len(labels)} candidates from {len(train_pages)} pages "
+          f"({int(labels.sum())} products) in {time.perf_counter() - started:.1f}s")
+
+    candidate = evaluate((model, vectorizer, app.build_feature_layout(model, vectorizer)), holdout_pages, tables)
+    print(f"New model on {len(holdout_pages)} held-out pages: {candidate}")
+
+    current = app.current_model()
+    if current is not None:
+        baseline = evaluate(current, holdout_pages, tables)
+        print(f"Current model on the same pages: {baseline}")
+        if candidate['f1'] < baseline['f1'] - tolerance and not force:
+            print("Keeping the current model")
+            return EXIT_REJECTED
+
+    save_model(model, vectorizer)
+    print(f"Promoted the new model to {app.MODEL_PATH} in {time.perf_counter() - started:.1f}s")
+    return EXIT_PROMOTED
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Retrain the product container model from saved pages')
+    parser.add_argument('--corpus', default=app.TRAINING_CORPUS_DIR, help='training corpus directory')
+    parser.add_argument('--cache-dir', help='feature cache (default: <corpus>/feature_cache)')
+    parser.add_argument('--jobs', type=int, default=-1, help='parallel featurizing and training jobs (-1: all cores)')
+    parser.add_argument('--holdout', type=float, default=0.2, help='share of pages held out for validation')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='promote even if held-out F1 is this much below the current model')
+    parser.add_argument('--force', action='store_true', help='promote without comparing to the current model')
+    # Set by POST /model/retrain, which takes the lock before starting this process
+    parser.add_argument('--lock-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if app.acquire_retrain_lock(args.lock_fd) is None:
+        print(f"Retraining is already running (see {app.RETRAIN_LOCK_PATH})")
+        sys.exit(EXIT_ERROR)
+
+    try:
+        code = retrain(args.corpus, args.cache_dir or os.path.join(args.corpus, 'feature_cache'),
+                       args.jobs, args.holdout, args.tolerance, args.force)
+    except Exception as e:
+        print(f"Retraining failed: {str(e)}")
+        code = EXIT_ERROR
+    sys.exit(code)
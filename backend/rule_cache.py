@@ -0,0 +1,141 @@
+"""In-memory LRU/TTL cache for per-domain extraction rules"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+def rule_cache_key(url, scope='domain'):
+    """Build the cache key for a URL
+
+    With scope 'domain' all pages of a site share rules. With scope 'path'
+    the key also includes the URL path with numeric segments replaced by '*',
+    so /p/123 and /p/456 share rules while /search and /p/123 do not.
+    """
+    parsed = urlparse(url)
+    if scope == 'domain':
+        return parsed.netloc
+
+    segments = ['*' if re.search(r'\d', segment) else segment
+                for segment in parsed.path.split('/') if segment]
+    return f"{parsed.netloc}/{'/'.join(segments)}"
+
+class RuleCache:
+    """Cache of extraction_rules dicts with LRU and TTL eviction
+
+    If a directory is given, entries are also written there as JSON so they
+    survive restarts and can be shared by several workers.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, directory=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        if self.directory and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get(self, key):
+        """Return the cached rules for key, or None on a miss"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+
+            if entry is not None and now - entry['stored_at'] <= self.ttl:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                self._evict()
+                self.hits += 1
+                return entry['rules']
+
+            # Expired or missing
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, rules):
+        """Store rules for key"""
+        entry = {'key': key, 'stored_at': time.time(), 'rules': rules}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._evict()
+            self._save(key, entry)
+
+    def invalidate(self, key):
+        """Drop rules that stopped matching the pages they were built for"""
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.directory:
+                path = self._path(key)
+                if os.path.exists(path):
+                    os.remove(path)
+            self.invalidations += 1
+
+    def clear(self):
+        """Drop every entry, e.g. after the model that learned them was replaced"""
+        with self.lock:
+            self.entries.clear()
+            if self.directory:
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json'):
+                        os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'maxEntries': self.max_entries,
+                'ttl': self.ttl
+            }
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('key') == key else None
+
+    def _save(self, key, entry):
+        """Write an entry to disk; a failure only loses it for other processes and restarts"""
+        if not self.directory:
+            return
+        # Write to a temporary file first so readers never see a partial entry
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Caching rules for {key} failed: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,40 @@
+"""Per-thread SQLite connections for the stores kept in database files
+
+The price history, result cache, job store and training corpus all open
+their database through ThreadConnections, so they share one set of
+connection settings: WAL journaling, synchronous=NORMAL, a 30 second
+busy timeout and autocommit (transactions are started explicitly).
+"""
+import os
+import sqlite3
+import threading
+
+# Seconds a connection waits for another process's write lock before failing
+BUSY_TIMEOUT = 30
+
+class ThreadConnections:
+    """One connection to a database file per thread
+
+    sqlite3 connections must not be shared between threads, nor with the
+    parent after a fork (gunicorn --preload builds the stores in the
+    master), so each thread opens its own and reopens it in a forked child.
+    """
+
+    def __init__(self, path, row_factory=None):
+        self.path = path
+        self.row_factory = row_factory
+        self.local = threading.local()
+        # The journal mode is stored in the file, setting it once is enough
+        self.get().execute('PRAGMA journal_mode=WAL')
+
+    def get(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            # With WAL a crash can lose the last commits but never corrupts the file
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
@@ -0,0 +1,84 @@
+"""Local stand-in for retailer sites, serving the pages in training_data/
+
+Pages are served by file name with ETag and Last-Modified headers, answer
+conditional requests with 304 and are gzip-compressed when the client
+accepts it, so the fetcher can be exercised without network access:
+
+    python backend/stand_in_server.py --port 8765
+    curl http://localhost:8765/www_myntra_com_20250426164506.html
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRAINING_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'training_data')
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve training pages with cache validators"""
+    directory = TRAINING_DATA_DIR
+
+    def do_GET(self):
+        name = os.path.basename(self.path.split('?', 1)[0])
+        path = os.path.join(self.directory, name)
+        if not name.endswith('.html') or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        mtime = int(os.path.getmtime(path))
+
+        if self._not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in_server(port=0, directory=TRAINING_DATA_DIR):
+    """Start the server on a background thread and return it (server.server_port has the port)"""
+    handler = type('Handler', (StandInHandler,), {'directory': directory})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve training_data/ pages like a retailer site')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StandInHandler)
+    print(f"Serving {TRAINING_DATA_DIR} on http://127.0.0.1:{args.port}/")
+    server.serve_forever()
@@ -345,7 +345,7 @@ export const ProductPriceChart = ({ priceHistory }) => {
     
     // Calculate point positions
     const points = dataPoints.map((point, index) => {
-      const x = (index / (dataPoints.length - 1)) * chartWidth;
+      const x = (index / (dataPoints.length - 1 || 1)) * chartWidth;
       const y = chartHeight - ((point.price - minPrice) / priceRange) * chartHeight;
       return { x, y, ...point };
     });